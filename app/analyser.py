@@ -1,8 +1,38 @@
-from ollama import chat
-from ollama import ChatResponse
 import json
+import sys
+import threading
+from typing import TYPE_CHECKING
 
 from .config import Config
+from .llm_cache import get_llm_cache
+from .metrics import metrics, SIZE_BUCKETS
+from .resilience import call_with_retries, get_llm_circuit_breaker
+
+if TYPE_CHECKING:
+    from ollama import ChatResponse
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def chat(model: str, messages: list, timeout: float = None) -> "ChatResponse":
+    """ Send a chat request to Ollama. A request that takes longer than `timeout` seconds fails.
+    Benchmarks replace this function with a fake one.
+    The Ollama client and its HTTP stack are imported with the first request, commands that do not use the LLM start faster.
+    """
+    with _clients_lock:
+        client = _clients.get(timeout)
+        if client is None:
+            from ollama import Client
+
+            client = Client(timeout=timeout)
+            _clients[timeout] = client
+    return client.chat(model=model, messages=messages)
+
+def is_retryable(error: Exception) -> bool:
+    """ Errors of the request itself, like a missing model, do not go away on retry """
+    # an Ollama error is only possible if the client was imported. The check does not import it
+    ollama = sys.modules.get("ollama")
+    return not (ollama is not None and isinstance(error, ollama.ResponseError) and 400 <= error.status_code < 500)
 
 class ContextAnalyser:
     """
@@ -10,8 +40,14 @@ class ContextAnalyser:
     It is used to extract user profile information, key topics and summary from the conversation.
     It uses the chat model to extract the information.
     """
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, cancel: threading.Event = None):
+        """
+        Args:
+            config (Config): Configuration object.
+            cancel (threading.Event): When set, new requests to the model fail with CancelledError and failed ones are not retried.
+        """
         self.config = config
+        self.cancel = cancel
         
     def extract_user_profile_info(self, message: str, current_info: dict) -> dict:
         """
@@ -34,6 +70,7 @@ class ContextAnalyser:
         Current user profile data is provided in the system message. It has to be taken into account and it has highter priority than the new data.
         Remember, the current user profile data is the result of analysis of the previous data.
         Your response should be in JSON format. The response should be clean JSON or text with JSON inside in ``` ``` format.
+        The data can contain several messages of the user. Newer messages have higher priority than older ones.
         If you don't find anything new, return the current user profile data. Do not remove any keys from the current user profile data without a reason.
 
         Example, return the data in the following format:
@@ -65,47 +102,65 @@ class ContextAnalyser:
             'content': message,
         },
         ]
-        response: ChatResponse = chat(model=self.config.extractor_model, messages=request)
-        result = self.__extract_json_document(response['message']['content'])
-        
-        try:
-            # The response 
-            # Parse the result as JSON
-            new_info = json.loads(result)
-
-            if len(new_info) == 0:
-                # If the result is empty, return the current info
-                return current_info
-            return new_info
-        except json.JSONDecodeError:
-            # If parsing fails, return the current info without changes
-            print(f"Failed to parse JSON: {result}")
+        new_info = self.__chat(
+            "extract_user_profile_info", self.config.extractor_model, request,
+            lambda content: self.__parse_json_object("extract_user_profile_info", content)
+        )
+
+        if new_info is None or len(new_info) == 0:
+            # If parsing fails or the result is empty, return the current info without changes
             return current_info
+        return new_info
 
-    def extract_key_topics(self, history: str, current_key_topics: dict) -> dict:
+    def extract_user_profile_info_batch(self, messages: list, current_info: dict) -> dict:
         """
-        Extracts key topics from the given data. It should take into account existent key topics.
-        If something new or different is found, it should be updated.
+        Extracts user profile information from many user messages. Messages are packed into requests 
+        of up to `profile_request_max_length` symbols, so the number of requests depends on the size of the text, not on the number of messages.
+        A message longer than the limit is sent in its own request.
+        If the limit is 0, every message is sent in its own request.
+        """
+        max_length = self.config.profile_request_max_length
+        batch = []
+        batch_length = 0
 
-        Example: 
-            current_key_topics = {
-                "sports": 5,
-                "music": 3,
-                "travel": 2
+        for message in messages:
+            if len(batch) > 0 and (max_length <= 0 or batch_length + len(message) > max_length):
+                current_info = self.extract_user_profile_info(self.__join_user_messages(batch), current_info)
+                batch = []
+                batch_length = 0
+
+            batch.append(message)
+            batch_length += len(message)
+
+        if len(batch) > 0:
+            current_info = self.extract_user_profile_info(self.__join_user_messages(batch), current_info)
+
+        return current_info
+
+    def extract_key_topics(self, history: str, known_key_topics: dict) -> dict:
+        """
+        Extracts key topics discussed in the given data with the number of their mentions in it.
+        Only topics of the given data are returned, the counts are merged with the stored ones by the caller.
+        Known topics are sent as a hint, so the same topic is named the same way every time.
+
+        Example of the result:
+            {
+                "sports": 2,
+                "music": 1
             }
         """
         system_hint = """
         You are a data extractor. Your task is to extract key topics from the given data.
-        You should take into account existent key topics. If something new or different is found, it should be updated.
         Topics can be anything, but they should be relevant to the data. It can be a phrase, a word or a sentence. 
         Take into account who provided the message, user or assistant. 
-        If a topic is already present in the current key topics, increase its count by 1.
+        Return only the topics discussed in the given data, with the number of times each of them is mentioned in it.
+        Known topics of the previous conversation are provided in the system message. If the data is about one of them,
+        use exactly the same name. Do not return known topics that are not in the given data.
 
         Return the data in the following format:
         {
-            "sports": 5,
-            "music": 3,
-            "travel": 2
+            "sports": 2,
+            "music": 1
         }
         """
         request = [
@@ -115,7 +170,7 @@ class ContextAnalyser:
         },
         {
             'role': 'system',
-            'content': f"Current key topics data:\n{current_key_topics}",
+            'content': f"Known key topics:\n{json.dumps(list(known_key_topics))}",
         },
         {
             'role': 'user',
@@ -123,19 +178,15 @@ class ContextAnalyser:
         },
         ]
         
-        response: ChatResponse = chat(model=self.config.extractor_model, messages=request)
-        
-        result = self.__extract_json_document(response['message']['content'])
-        
-        try:
-            # Parse the result as JSON
-            new_key_topics = json.loads(result)
+        new_key_topics = self.__chat(
+            "extract_key_topics", self.config.extractor_model, request,
+            lambda content: self.__parse_json_object("extract_key_topics", content)
+        )
 
-            return new_key_topics
-        except json.JSONDecodeError:
-            # If parsing fails, return the current info without changes
-            print(f"Failed to parse JSON: {result}")
-            return current_key_topics
+        if new_key_topics is None:
+            # If parsing fails, no topics are found in the data
+            return {}
+        return new_key_topics
         
     def extract_summary(self, history: str, current_summary: str) -> str:
         """
@@ -165,10 +216,112 @@ class ContextAnalyser:
             'content': f"Make the summary from the following data:\n{history}",
         },
         ]
-        response: ChatResponse = chat(model=self.config.summarizer_model, messages=request)
+        content = self.__chat("extract_summary", self.config.summarizer_model, request)
 
-        return response['message']['content']
+        return content
     
+    def merge_summaries(self, summaries: list) -> str:
+        """
+        Merges summaries of consecutive parts of the conversation into one summary.
+        Summaries are ordered from older to newer.
+        """
+        system_hint = f"""
+        You are a context analyser. Your task is to merge summaries of consecutive parts of a conversation into one summary.
+        The summaries are ordered from older to newer. If they contradict each other, newer information has higher priority.
+        Keep the facts that are important for future context reference to know what was discussed.
+        The final summary should not be longer than {self.config.summarizer_response_max_length} symbols.
+        """
+        parts = "\n\n".join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(summaries))
+        request = [
+        {
+            'role': 'system',
+            'content': system_hint,
+        },
+        {
+            'role': 'user',
+            'content': f"Merge the following summaries:\n{parts}",
+        },
+        ]
+        content = self.__chat("merge_summaries", self.config.summarizer_model, request)
+
+        return content
+
+    def __chat(self, method: str, model: str, request: list, parse=None):
+        """ Send the request to the model and return the content of the response. Responses are cached if the LLM cache is enabled.
+        Number of requests, their latency and sizes are reported in metrics labeled with the analyser method.
+
+        Args:
+            parse (callable): Turns the content into the result. It returns None if the response is not valid.
+                Invalid responses are not cached and an invalid cached response is removed, so the next request asks the model again.
+        Returns:
+            The content of the response, or the result of `parse`.
+        """
+        metrics.observe("llm_prompt_symbols", sum(len(message['content']) for message in request), SIZE_BUCKETS, method=method)
+
+        cache = get_llm_cache(self.config)
+        key = None
+        cached = False
+        if cache is None:
+            metrics.inc("llm_requests_total", method=method, cache="off")
+            content = self.__request(method, model, request)
+        else:
+            key = cache.key(model, request)
+            content = cache.get(key)
+            cached = content is not None
+            if cached:
+                metrics.inc("llm_requests_total", method=method, cache="hit")
+            else:
+                metrics.inc("llm_requests_total", method=method, cache="miss")
+                content = self.__request(method, model, request)
+
+        metrics.observe("llm_response_symbols", len(content), SIZE_BUCKETS, method=method)
+
+        result = content if parse is None else parse(content)
+        if cache is not None:
+            if result is None and cached:
+                cache.delete(key)
+            elif result is not None and not cached:
+                cache.put(key, content)
+        return result
+
+    def __request(self, method: str, model: str, request: list) -> str:
+        """ Call the model. Every attempt has `llm_timeout` seconds, failed attempts are retried up to `llm_retries` times.
+        Failures are counted by the LLM circuit breaker, the request fails at once with CircuitOpenError while it is open.
+        """
+        def attempt() -> str:
+            with metrics.timed("llm_request_duration_seconds", method=method, model=model):
+                response: "ChatResponse" = chat(model=model, messages=request, timeout=self.config.llm_timeout)
+            return response['message']['content']
+
+        return call_with_retries(
+            attempt,
+            self.config.llm_retries,
+            self.config.llm_retry_backoff,
+            get_llm_circuit_breaker(self.config),
+            is_retryable,
+            self.cancel,
+        )
+
+    def __parse_json_object(self, method: str, content: str) -> dict:
+        """ Parse the JSON object of the response. Returns None if the response has no JSON object, the failure is reported in metrics """
+        result = self.__extract_json_document(content)
+        try:
+            data = json.loads(result)
+        except json.JSONDecodeError:
+            data = None
+
+        if not isinstance(data, dict):
+            print(f"Failed to parse JSON: {result}")
+            metrics.inc("llm_json_parse_failures_total", method=method)
+            return None
+        return data
+
+    def __join_user_messages(self, messages: list) -> str:
+        """ Join user messages into one request. A single message is sent as is """
+        if len(messages) == 1:
+            return messages[0]
+        return "Messages of the user, from older to newer:\n\n" + "\n\n".join(messages)
+
     def __extract_json_document(self, data: str) -> dict:
         """
         Extracts JSON from the given data. It can be that a data is soe text and it has JSON inside in ``` ``` format.
@@ -0,0 +1,194 @@
+import math
+import re
+
+from .config import Config
+
+# Average number of characters per token of model families, for English text.
+# The values are a bit lower than measured, so the estimates err on the side of more tokens
+CHARS_PER_TOKEN = {
+    "qwen": 3.3,
+    "llama": 3.6,
+    "mistral": 3.2,
+    "gemma": 3.6,
+    "phi": 3.2,
+    "deepseek": 3.3,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.2
+
+# Tokens of the system hints and the message framing of the analyser prompts
+PROMPT_OVERHEAD_TOKENS = 600
+
+SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
+
+def estimate_tokens(text: str, model: str) -> int:
+    """
+    Estimate the number of tokens of the text for the model without loading its tokenizer.
+    Characters outside ASCII are counted as a token each, they are rarely merged with others.
+    """
+    if not text:
+        return 0
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    ratio = DEFAULT_CHARS_PER_TOKEN
+    name = model.lower()
+    for family, family_ratio in CHARS_PER_TOKEN.items():
+        if family in name:
+            ratio = family_ratio
+            break
+    return math.ceil((len(text) - non_ascii) / ratio) + non_ascii
+
+class Chunk:
+    """ A part of the history that is analysed with one set of LLM requests """
+    def __init__(self):
+        self.history = ""
+        self.user_messages = []
+        self.row_ids = [] # messages with text in the chunk, in order
+        self.tokens = 0
+        self.complete = True # False when the last message continues in the next chunk
+
+    @property
+    def done_ids(self) -> list:
+        """ Messages that end in this chunk. They are fully analysed when the chunk is """
+        if self.complete:
+            return self.row_ids
+        return self.row_ids[:-1]
+
+class HistoryChunker:
+    """
+    Packs messages into chunks that fill the analyser requests close to `analyser_token_budget` tokens.
+
+    The history of a chunk is sent to the key topics and summary requests together with the current state
+    (key topics or summary) and the system hint, so the space they take is reserved before the chunk is filled.
+    The state is checked again for every chunk, as it changes while the history is analysed.
+    A chunk also ends when its history gets longer than `summarizer_request_max_length` symbols.
+    Messages that do not fit into a chunk alone are split at sentence boundaries.
+    """
+    def __init__(self, config: Config, models: list):
+        """
+        Args:
+            config (Config): Configuration object with the token budget.
+            models (list): Models the history is sent to. Tokens are estimated for the model with the largest count.
+        """
+        self.config = config
+        self.models = models
+
+    def estimate(self, text: str) -> int:
+        """ Tokens of the text for the most demanding of the models """
+        return max(estimate_tokens(text, model) for model in self.models)
+
+    def state_tokens(self, key_topics: dict, summary: str) -> int:
+        """ Tokens taken in a request by everything except the history: system hints, the current state and the summary response """
+        summary_tokens = 0
+        if summary is not None:
+            summary_tokens = self.estimate(summary) + self.estimate("x" * self.config.summarizer_response_max_length)
+        return PROMPT_OVERHEAD_TOKENS + max(self.estimate(str(key_topics)), summary_tokens)
+
+    def chunks(self, rows, reserved_tokens=None):
+        """
+        Group rows into chunks.
+        Args:
+            rows (iterable): (id, role, data) tuples ordered by id.
+            reserved_tokens (callable): Returns the tokens taken by the state in the requests. Called when a chunk is started.
+        Returns:
+            generator: Yields Chunk objects.
+        """
+        chunk = None
+        budget = 0
+
+        for row_id, role, content in rows:
+            line = f"{role}: {content}\n\n"
+            tokens = self.estimate(line)
+            fits = tokens <= budget and len(line) <= self.config.summarizer_request_max_length
+
+            if chunk is not None and (chunk.tokens + tokens > budget or len(chunk.history) + len(line) > self.config.summarizer_request_max_length):
+                # a message that has to be split anyway starts in the space left in the chunk, unless little is left
+                if fits or chunk.tokens > budget * 3 // 4 or len(chunk.history) > self.config.summarizer_request_max_length * 3 // 4:
+                    yield chunk
+                    chunk = None
+
+            if chunk is None:
+                chunk = Chunk()
+                budget = self.__budget(reserved_tokens)
+                fits = tokens <= budget and len(line) <= self.config.summarizer_request_max_length
+
+            if fits:
+                self.__add(chunk, row_id, role, content, line, tokens)
+                continue
+
+            framing_tokens = self.estimate(f"{role}: \n\n")
+            framing_chars = len(role) + 4
+            pieces = self.__split(
+                content,
+                (budget - framing_tokens, self.config.summarizer_request_max_length - framing_chars),
+                (budget - chunk.tokens - framing_tokens, self.config.summarizer_request_max_length - len(chunk.history) - framing_chars),
+            )
+            for i, piece in enumerate(pieces):
+                if i > 0:
+                    chunk.complete = False
+                    yield chunk
+                    chunk = Chunk()
+                    budget = self.__budget(reserved_tokens)
+                piece_line = f"{role}: {piece}\n\n"
+                self.__add(chunk, row_id, role, piece, piece_line, self.estimate(piece_line))
+
+        if chunk is not None:
+            yield chunk
+
+    def __budget(self, reserved_tokens) -> int:
+        """ Tokens left for the history of a new chunk. At least a quarter of the budget is always left for the history """
+        reserved = reserved_tokens() if reserved_tokens is not None else PROMPT_OVERHEAD_TOKENS
+        return max(self.config.analyser_token_budget - reserved, self.config.analyser_token_budget // 4)
+
+    def __add(self, chunk: Chunk, row_id: int, role: str, content: str, line: str, tokens: int) -> None:
+        if role == "user":
+            chunk.user_messages.append(content)
+        chunk.history += line
+        chunk.tokens += tokens
+        chunk.row_ids.append(row_id)
+
+    def __split(self, text: str, limits: tuple, first_limits: tuple) -> list:
+        """ Split the text into pieces that fit the (tokens, symbols) limits. The first piece has its own limits.
+        Pieces end at sentence boundaries, sentences longer than a piece are cut
+        """
+        pieces = []
+        piece = ""
+
+        def limit():
+            max_tokens, max_chars = first_limits if len(pieces) == 0 else limits
+            return max(1, max_tokens), max(1, max_chars)
+
+        for sentence in SENTENCE_END.split(text):
+            max_tokens, max_chars = limit()
+            candidate = sentence if piece == "" else f"{piece} {sentence}"
+            if self.estimate(candidate) <= max_tokens and len(candidate) <= max_chars:
+                piece = candidate
+                continue
+
+            if piece != "":
+                pieces.append(piece)
+                piece = ""
+                max_tokens, max_chars = limit()
+
+            while self.estimate(sentence) > max_tokens or len(sentence) > max_chars:
+                cut = self.__cut_position(sentence, max_tokens, max_chars)
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+                max_tokens, max_chars = limit()
+            piece = sentence
+
+        if piece != "":
+            pieces.append(piece)
+        return pieces
+
+    def __cut_position(self, text: str, max_tokens: int, max_chars: int) -> int:
+        """ The longest prefix that fits the limits, cut at a space if there is one """
+        low, high = 1, min(len(text), max_chars)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.estimate(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        space = text.rfind(" ", 0, low)
+        if space > low // 2:
+            return space
+        return low
@@ -7,12 +7,72 @@ class Config:
         self.error_traceback = False
 
         self.database_file_path = "memories.db"
+        self.database_pool_size = 4 # connections
+        self.database_pool_timeout = 30.0 # seconds to wait for a free connection
+        self.database_busy_timeout = 5.0 # seconds to wait for a locked database
+        self.database_cache_size_kb = 16384
+        self.database_mmap_size = 268435456 # bytes
+        self.database_fetch_batch_size = 1000 # rows loaded at once when iterating over messages
+        self.import_batch_size = 10000 # messages stored with one transaction by the import
+        self.import_lease_ttl = 300.0 # seconds. An import with deferred index renews it after every batch. If it expires, the import was killed and others finish the index
+
         self.extractor_model = "mistral-nemo"
         self.summarizer_model = "qwen2.5:3b"
-        self.summarizer_request_max_length = 30000 # symbols
+        self.summarizer_request_max_length = 30000 # symbols of history in one request. A hard cap on top of the token budget
+        self.analyser_token_budget = 8192 # tokens of one analyser request: system hint, current state and the chunk of history. Keep it below the context size of the models
         self.summarizer_response_max_length = 3000
+        self.profile_request_max_length = 10000 # symbols of user messages per profile extraction request. 0 - one request per message
+        self.key_topics_context_size = 50 # most mentioned key topics sent to the LLM as known topics and returned by recall
+        self.analyser_concurrency = 3 # parallel LLM requests while patching memories
+        self.summary_mode = "sequential" # "sequential" - every chunk updates the summary. "map_reduce" - chunks are summarized independently and merged in a tree
+        self.summary_merge_fan_in = 4 # summaries merged by one request in the "map_reduce" mode
+        self.llm_timeout = 300.0 # seconds for one LLM request
+        self.llm_retries = 2 # retries of a failed LLM request
+        self.llm_retry_backoff = 2.0 # seconds before the first retry. Doubled for every next one
+        self.llm_circuit_failure_threshold = 5 # failed LLM requests in a row that pause the analysis
+        self.llm_circuit_reset_timeout = 60.0 # seconds the analysis is paused before the LLM is tried again
+        self.llm_cache_file_path = "llm_cache.db" # cache of LLM responses. Empty to disable
+        self.llm_cache_max_entries = 10000
+
+        self.remember_buffer_enabled = False # buffer single remembered messages and write them in batches
+        self.remember_buffer_max_size = 50 # messages. The buffer is written when it has this many messages
+        self.remember_buffer_max_delay = 1.0 # seconds. Messages never wait in the buffer longer than this
+
+        self.tool_executor_workers = 8 # threads running the blocking work of MCP tools
+        self.tool_concurrency_limit = 4 # calls of one MCP tool running at the same time. Other calls wait
+        self.tool_timeout = 30.0 # seconds. A tool call fails if it takes longer
+
+        self.recall_summary_segment_length = 400 # symbols. The summary is split into segments of about this size for the query-scoped recall
+
+        self.search_results_limit = 5 # number of best matches returned by search
+        self.search_context_window = 5 # messages before and after each match
+
+        self.embedding_backend = "" # "ollama", "hash" (local, without a model) or empty to disable semantic search
+        self.embedding_model = "nomic-embed-text"
+        self.embedding_dimensions = 256 # vector size of the "hash" backend
+        self.embedding_batch_size = 64 # messages per embedding request
 
         self.auto_patch_when_num_of_messages_is_greater_then = 4
+        self.scheduler_debounce = 0.05 # seconds without new messages before a patch starts
+        self.scheduler_max_latency = 1.0 # seconds. A patch starts at most this long after the threshold is crossed
+        self.scheduler_retry_delay = 30.0 # seconds to wait after a failed patch
+        self.scheduler_workers = 1 # tenants patched at the same time
+        self.scheduler_stop_timeout = 10.0 # seconds the server waits for running patches when it stops
+        self.scheduler_lease_ttl = 30.0 # seconds. Only the process holding the scheduler lease patches memories. It is renewed 3 times per period
+        self.scheduler_lease_file_path = "" # database of the scheduler lease. The default database path with "-scheduler" added by default
+        self.claim_ttl = 600.0 # seconds an analyser holds the messages it claimed. Renewed after every chunk
+        self.claim_batch_size = 100 # messages claimed at once by an analyser
+        self.patch_max_messages = 1000 # messages analysed by one scheduled patch. Then other tenants get their turn
+
+        self.compaction_enabled = False # move old analysed messages to the compressed archive after scheduled patches
+        self.compaction_keep_messages = 10000 # newest messages that always stay in the memory table
+        self.compaction_retention_days = 30.0 # messages stored within this many days always stay in the memory table. 0 to keep only by the number
+        self.compaction_segment_size = 1000 # messages in one compressed archive segment
+        self.compaction_vacuum_pages = 1000 # free pages released by one incremental vacuum step
+
+        self.tenants_enabled = False # keep the memory of every auth token in its own database
+        self.tenants_directory = "tenants"
+        self.tenant_cache_size = 32 # tenants kept open
 
         if env_file_path != "":
             load_dotenv(env_file_path)
@@ -22,8 +82,20 @@ class Config:
 
     def __parseEnv(self) -> None:
         """
-            Set values from ENV. Overwrite values for config
+            Set values from ENV. Overwrite values for config.
+            Values are converted to the type of the default value.
         """
-        for attr, _ in vars(self).items():
-            if os.environ.get(attr.upper()) is not None:
-                setattr(self, attr, os.environ.get(attr.upper()))
\ No newline at end of file
+        for attr, default in vars(self).items():
+            value = os.environ.get(attr.upper())
+            if value is not None:
+                setattr(self, attr, self.__convert(value, default))
+
+    def __convert(self, value: str, default):
+        """ Convert the ENV string to the type of the default value """
+        if isinstance(default, bool):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        if isinstance(default, int):
+            return int(value)
+        if isinstance(default, float):
+            return float(value)
+        return value
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import re
+import threading
+from typing import TYPE_CHECKING
+
+from .config import Config
+from .store import Store
+
+if TYPE_CHECKING:
+    import numpy as np
+
+class Embedder:
+    """
+    Embedder turns texts into vectors. Subclasses implement `embed`.
+    """
+    def embed(self, texts: list) -> list:
+        """
+        Args:
+            texts (list): Texts to embed.
+        Returns:
+            list: One vector (list of floats) per text.
+        """
+        raise NotImplementedError()
+
+class OllamaEmbedder(Embedder):
+    """ Embeddings from the Ollama embedding model set in `embedding_model` """
+    def __init__(self, config: Config):
+        self.config = config
+
+    def embed(self, texts: list) -> list:
+        from ollama import embed
+
+        response = embed(model=self.config.embedding_model, input=texts)
+        return response['embeddings']
+
+class HashEmbedder(Embedder):
+    """
+    Local embedder without a model. Words are hashed into a fixed number of dimensions.
+    It is deterministic and fast, but only finds texts that share words with the query.
+    """
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def embed(self, texts: list) -> list:
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.md5(word.encode()).digest()
+                index = int.from_bytes(digest[:4], "little") % self.dimensions
+                vector[index] += 1.0 if digest[4] & 1 else -1.0
+            vectors.append(vector)
+        return vectors
+
+def create_embedder(config: Config) -> Embedder:
+    """ Create the embedder set in `embedding_backend`. Returns None if semantic search is disabled """
+    if config.embedding_backend == "ollama":
+        return OllamaEmbedder(config)
+    if config.embedding_backend == "hash":
+        return HashEmbedder(config.embedding_dimensions)
+    if config.embedding_backend == "":
+        return None
+    raise ValueError(f"Unknown embedding backend: {config.embedding_backend}")
+
+class VectorIndex:
+    """
+    Embeddings of the messages in the memory table.
+
+    Vectors are normalized and stored as float32 blobs in the memory_embeddings table.
+    For queries they are loaded into one NumPy matrix, which is extended with new rows when they appear.
+    NumPy is imported when the index is created, so it is not loaded when semantic search is disabled.
+    """
+    def __init__(self, store: Store, embedder: Embedder, batch_size: int):
+        """
+        Args:
+            store (Store): The database with the memory table.
+            embedder (Embedder): Embedder for messages and queries.
+            batch_size (int): Number of messages to embed per request.
+        """
+        self.store = store
+        self.embedder = embedder
+        self.batch_size = batch_size
+
+        import numpy as np
+
+        self.__lock = threading.Lock()
+        self.__ids = np.zeros(0, dtype=np.int64)
+        self.__matrix = None
+        # messages up to this id have embeddings. Ids only grow, so the search for pending messages starts after it
+        self.__embedded_up_to = 0
+
+    def index_pending(self, limit: int = None) -> int:
+        """ Embed the messages that do not have embeddings yet, older first. Returns the number of embedded messages.
+
+        Args:
+            limit (int): Maximum number of messages to embed. The rest are embedded by the next calls. All messages by default.
+        """
+        count = 0
+        while limit is None or count < limit:
+            batch_size = self.batch_size if limit is None else min(self.batch_size, limit - count)
+            with self.store.connection("read_embeddings") as conn:
+                rows = conn.execute("""
+                    SELECT memory.id, memory.role, memory.data FROM memory
+                    LEFT JOIN memory_embeddings ON memory_embeddings.id = memory.id
+                    WHERE memory.id > ? AND memory_embeddings.id IS NULL
+                    ORDER BY memory.id
+                    LIMIT ?
+                """, (self.__embedded_up_to, batch_size)).fetchall()
+
+            if len(rows) == 0:
+                return count
+
+            vectors = self.embedder.embed([self.__message_text(role, data) for _, role, data in rows])
+
+            with self.store.connection("save_embeddings") as conn, conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO memory_embeddings (id, vector) VALUES (?, ?)",
+                    [(row[0], self.__normalize(vector).tobytes()) for row, vector in zip(rows, vectors)]
+                )
+            self.__embedded_up_to = max(self.__embedded_up_to, rows[-1][0])
+            count += len(rows)
+        return count
+
+    def search(self, query: str, limit: int) -> list:
+        """
+        Find the messages closest to the query by cosine similarity.
+        Returns:
+            list: (id, score) tuples, best match first.
+        """
+        import numpy as np
+
+        ids, matrix = self.__load()
+        if matrix is None or limit <= 0:
+            return []
+
+        vector = self.__normalize(self.embedder.embed([query])[0])
+        scores = matrix @ vector
+
+        limit = min(limit, len(scores))
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+
+        return [(int(ids[i]), float(scores[i])) for i in best]
+
+    def __load(self) -> tuple:
+        """ Load new vectors into the matrix. The matrix is reloaded if the table changed in other ways than new rows """
+        import numpy as np
+
+        with self.__lock:
+            loaded_max_id = int(self.__ids[-1]) if len(self.__ids) > 0 else 0
+
+            with self.store.connection("read_embeddings") as conn:
+                total = conn.execute("SELECT COUNT(*) FROM memory_embeddings").fetchone()[0]
+                rows = conn.execute(
+                    "SELECT id, vector FROM memory_embeddings WHERE id > ? ORDER BY id", (loaded_max_id,)
+                ).fetchall()
+                if len(self.__ids) + len(rows) != total:
+                    self.__ids = np.zeros(0, dtype=np.int64)
+                    self.__matrix = None
+                    rows = conn.execute("SELECT id, vector FROM memory_embeddings ORDER BY id").fetchall()
+
+            if len(rows) > 0:
+                ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+                if self.__matrix is not None:
+                    ids = np.concatenate([self.__ids, ids])
+                    matrix = np.vstack([self.__matrix, matrix])
+                self.__ids = ids
+                self.__matrix = matrix
+
+            return self.__ids, self.__matrix
+
+    def __normalize(self, vector) -> "np.ndarray":
+        """ Convert to float32 with unit length, so the dot product is the cosine similarity """
+        import numpy as np
+
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        return vector
+
+    def __message_text(self, role: str, data: str) -> str:
+        """ The text of a stored message to embed """
+        contents = json.loads(data)
+        if not isinstance(contents, str):
+            contents = data
+        return f"{role}: {contents}"
@@ -0,0 +1,47 @@
+import gzip
+import json
+import sys
+
+def open_text(path: str, mode: str):
+    """ Open a text file for reading ("r") or writing ("w"). Files ending with .gz are compressed, - is stdin or stdout """
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def read_jsonl(path: str):
+    """
+    Read objects from a JSON lines file, one at a time. Empty lines are skipped.
+    Returns:
+        generator: Yields the objects. Raises ValueError with the line number for a line that is not JSON.
+    """
+    f = open_text(path, "r")
+    try:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {number} is not JSON: {e}")
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def write_jsonl(path: str, records) -> int:
+    """ Write the objects to a JSON lines file. Returns the number of written objects """
+    f = open_text(path, "w")
+    count = 0
+    try:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    finally:
+        if f is sys.stdout:
+            f.flush()
+        else:
+            f.close()
+    return count
@@ -0,0 +1,49 @@
+import os
+import socket
+import time
+import uuid
+
+from .store import Store
+
+_process_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def new_owner_id() -> str:
+    """ A unique owner id for leases and claimed messages. It tells the host and the process of the owner """
+    return f"{_process_id}:{uuid.uuid4().hex[:8]}"
+
+class Lease:
+    """
+    A named lease in the database. Only one owner holds it at a time.
+
+    The holder has to renew the lease before it expires, otherwise another owner can take it.
+    Processes that share the database use it to elect the one that runs a job.
+    """
+    def __init__(self, store: Store, name: str, owner: str, ttl: float):
+        """
+        Args:
+            store (Store): The database of the lease.
+            name (str): Name of the lease.
+            owner (str): Id of this owner.
+            ttl (float): Seconds the lease is held after it is acquired or renewed.
+        """
+        self.store = store
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+
+    def acquire(self) -> bool:
+        """ Take the lease if it is free or expired, or renew it if it is held by this owner. Returns True if the lease is held """
+        now = time.time()
+        with self.store.connection("lease") as conn, conn:
+            row = conn.execute("""
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+                RETURNING owner
+            """, (self.name, self.owner, now + self.ttl, now)).fetchone()
+        return row is not None
+
+    def release(self) -> None:
+        """ Free the lease if it is held by this owner """
+        with self.store.connection("lease") as conn, conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from .config import Config
+
+class LLMCache:
+    """
+    Persistent cache of LLM responses in its own SQLite file.
+
+    Responses are keyed by a hash of the model and the full list of request messages (system prompt, current state and history),
+    so an identical request is answered from the cache. The cache keeps at most `llm_cache_max_entries` responses,
+    the least recently used ones are removed first.
+    """
+    def __init__(self, config: Config):
+        """
+        Args:
+            config (Config): Configuration object with `llm_cache_file_path` and `llm_cache_max_entries`.
+        """
+        self.config = config
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(config.llm_cache_file_path, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode = WAL")
+        self.__conn.execute("PRAGMA synchronous = NORMAL")
+        with self.__conn:
+            self.__conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+        self.__entries = self.__conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+    def key(self, model: str, messages: list) -> str:
+        """ The cache key of a request """
+        return hashlib.sha256(json.dumps([model, messages], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        """ Returns the cached response, or None """
+        with self.__lock:
+            row = self.__conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            with self.__conn:
+                self.__conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """ Store a response. The least recently used responses are removed if the cache is full """
+        with self.__lock, self.__conn:
+            cursor = self.__conn.execute(
+                "INSERT OR IGNORE INTO llm_cache (key, response, last_used) VALUES (?, ?, ?)",
+                (key, response, time.time())
+            )
+            self.__entries += cursor.rowcount
+
+            excess = self.__entries - self.config.llm_cache_max_entries
+            if excess > 0:
+                cursor = self.__conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+                self.__entries -= cursor.rowcount
+
+    def delete(self, key: str) -> None:
+        """ Remove a response, for example one that turned out to be invalid """
+        with self.__lock, self.__conn:
+            cursor = self.__conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.__entries -= cursor.rowcount
+
+    def stats(self) -> dict:
+        """ Hits and misses since the cache was opened and the number of cached responses """
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self.__entries}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_llm_cache(config: Config) -> LLMCache:
+    """
+    Returns the process-wide LLM cache for the file from the config. Returns None if the cache is disabled.
+    """
+    if config.llm_cache_file_path == "":
+        return None
+    with _caches_lock:
+        cache = _caches.get(config.llm_cache_file_path)
+        if cache is None:
+            cache = LLMCache(config)
+            _caches[config.llm_cache_file_path] = cache
+        return cache
@@ -1,88 +1,213 @@
 import json 
-import sqlite3
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from concurrent.futures import Future
 from .config import Config
+from .store import FTS_IMPORT_LEASE, Store, get_store
 from .analyser import ContextAnalyser
+from .pipeline import ExtractionPipeline
+from .chunker import HistoryChunker, SENTENCE_END
+from .topics import merge_topics, top_topics
+from .embeddings import VectorIndex, create_embedder
+from .metrics import metrics
+from .resilience import CancelledError
+from .leases import Lease, new_owner_id
+
+def to_timestamp(value) -> float:
+    """ Convert a time to seconds since the epoch. The time is a number of seconds or an ISO 8601 string, UTC unless it has a zone """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid time: {value}. Use ISO 8601, like 2025-01-31 or 2025-01-31T18:00:00+02:00")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+def to_isoformat(timestamp: float) -> str:
+    """ ISO 8601 UTC string of the time in seconds since the epoch """
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
 
 class Memory:
     """
     Memory class to handle memory operations using SQLite.
 
     Manages tables: 
-    - memory: stores the role and data for each message. This is tyhe full original history of the conversation.
+    - memory: stores the role, data and creation time of each message. This is tyhe full original history of the conversation.
+      A message is pending until it is analysed. While an analyser works on it, it is claimed: claimed_by tells the analyser
+      and claim_expires the time when other analysers can take it if the claim is not renewed
     - user_profile: stores the user profile data. It is data extracted from the conversation using LLM. It is only most relevant data about the user, like the name
-    - key_topics: stores the key topics of the conversation. It is data extracted from the conversation using LLM. Topic and count of mentions
-    - summary: stores the summary of the conversation. It is the one row table
+    - key_topics: stores the key topics of the conversation. It is data extracted from the conversation using LLM. Topic and count of mentions.
+      The LLM finds topics of every chunk of history, their counts are added to the stored ones
+    - summary: stores the summary of the conversation. The summary is the row with empty reference. In the map-reduce summary mode
+      the table also keeps summaries of chunks (reference leaf:<first id>-<last id>) and their merges (node:<level>:<position>:<first id>-<last id>)
+    - memory_archive: stores old analysed messages moved out of the memory table by compaction, in compressed segments.
+      They are still returned by the history and found by search
+    - memory_embeddings: stores the embedding vector of each message for the semantic search
+    - memory_fragments: full-text index of the user profile keys, the most mentioned key topics and segments of the summary.
+      It is rebuilt every time they change and is used by the query-scoped recall
+    - metadata: stores counters. `generation` is increased every time the user profile, key topics or summary change
+    - leases: named leases that elect one of the processes using the database to run a job, see Lease
     """
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, store: Store = None):
         """
         Initialize the Memory class with a Config object.
         
         Args:
             config (Config): Configuration object containing database file path and other settings.
+            store (Store): Connection pool to use. The process-wide store for the database file is used by default.
         """
         self.config = config
-        self.conn = sqlite3.connect(self.config.database_file_path)
-        self._create_tables()
-
-    def __del__(self):
-        """ Close the database connection when the object is deleted. """
-        if self.conn:
-            self.conn.close()
-
-    def _create_tables(self):
-        """Create tables if they do not exist."""
-        with self.conn:
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS memory (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    role TEXT NOT NULL,
-                    data TEXT NOT NULL,
-                    analysed INTEGER DEFAULT 0
-                )
-            """)
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_profile (
-                    key TEXT NOT NULL PRIMARY KEY,
-                    data TEXT NOT NULL
-                )
-            """)
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS key_topics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    topic TEXT NOT NULL,
-                    count INTEGER NOT NULL
-                )
-            """)
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS summary (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    reference TEXT NOT NULL,
-                    summary TEXT NOT NULL
-                )
-            """)
+        self.store = store if store is not None else get_store(config)
+        self.__remember_listeners = []
+        self.__recall_cache = None # (generation, recall text)
+        self.__recall_cache_lock = threading.Lock()
+        self.__vector_index = None
+        self.__vector_index_lock = threading.Lock()
 
-    def history_dump(self):
+    def add_remember_listener(self, listener) -> None:
+        """
+        Register a function to call after new messages are stored.
+        Args:
+            listener (callable): Called with the number of stored messages.
+        """
+        self.__remember_listeners.append(listener)
+
+    def history_dump(self, start_id: int = None, end_id: int = None, limit: int = None, since=None, until=None, role: str = None):
         """ Returns the history of the memory. All messages stored in teh DB
+        Messages are read from the database in batches, so the memory use does not depend on the size of the history.
+
+        Args:
+            start_id (int): The first message id to return.
+            end_id (int): The last message id to return.
+            limit (int): Maximum number of messages to return.
+            since (str | float): Return messages stored at this time or later. ISO 8601 string or seconds since the epoch.
+            until (str | float): Return messages stored at this time or earlier.
+            role (str): Return only messages of this role.
 
         Returns:
             generator: A generator that yields each message in the memory.
         """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, role, data FROM memory")
-        rows = cursor.fetchall()
-
-        for row in rows:
-            row_id, role, content = row
+        for row_id, role, content in self.iterate_messages(start_id, end_id, limit, since=since, until=until, role=role):
             yield f"{row_id}: {role}: {content}"
-        cursor.close()
+
+    def history_page(self, start_id: int = None, end_id: int = None, limit: int = 100, since=None, until=None, role: str = None) -> tuple:
+        """ Returns one page of the history.
+
+        Args:
+            start_id (int): The first message id of the page.
+            end_id (int): The last message id to return.
+            limit (int): Maximum number of messages in the page.
+            since, until, role: Filters of the messages, see history_dump.
+
+        Returns:
+            tuple: (rows, next start id). Rows are (id, role, data) tuples. The next start id is None when there are no more messages.
+        """
+        rows = list(self.iterate_messages(start_id, end_id, limit + 1, since=since, until=until, role=role))
+        if len(rows) > limit:
+            return rows[:limit], rows[limit][0]
+        return rows, None
+
+    def iterate_messages(self, start_id: int = None, end_id: int = None, limit: int = None, only_unanalysed: bool = False,
+                         since=None, until=None, role: str = None, with_time: bool = False):
+        """ Iterate over messages ordered by id. Messages are loaded in batches of `database_fetch_batch_size` rows
+        with keyset pagination. A database connection is only held while a batch is loaded.
+
+        Args:
+            start_id (int): The first message id to return.
+            end_id (int): The last message id to return.
+            limit (int): Maximum number of messages to return.
+            only_unanalysed (bool): Return only messages that are not analysed yet.
+            since (str | float): Return messages stored at this time or later. Messages without the time are skipped.
+            until (str | float): Return messages stored at this time or earlier. Messages without the time are skipped.
+            role (str): Return only messages of this role.
+            with_time (bool): Add the time the message was stored to the tuples.
+
+        Returns:
+            generator: Yields (id, role, data) tuples, or (id, role, data, created_at) with the time.
+        """
+        since, until = to_timestamp(since), to_timestamp(until)
+        # pages are read by id, the filters are checked on the rows and do not use the indexes
+        conditions, filter_params = self.__filter_sql(since, until, role, "+")
+        if len(conditions) > 0:
+            with self.store.connection("read_history") as conn:
+                bounds = self.__filtered_id_range(conn, since, until, role, not only_unanalysed)
+            if bounds is None:
+                return
+            start_id = max(start_id or 0, bounds[0])
+            end_id = bounds[1] if end_id is None else min(end_id, bounds[1])
+
+        query = f"SELECT id, role, data{', created_at' if with_time else ''} FROM memory WHERE id >= ?"
+        if end_id is not None:
+            query += " AND id <= ?"
+        if only_unanalysed:
+            query += " AND analysed = 0"
+        for condition in conditions:
+            query += f" AND {condition}"
+        query += " ORDER BY id LIMIT ?"
+
+        next_id = start_id if start_id is not None else 0
+        left = limit
+
+        while left is None or left > 0:
+            batch_size = self.config.database_fetch_batch_size
+            if left is not None:
+                batch_size = min(batch_size, left)
+
+            params = [next_id]
+            if end_id is not None:
+                params.append(end_id)
+            params += filter_params
+            params.append(batch_size)
+
+            with self.store.connection("read_history") as conn:
+                rows = conn.execute(query, params).fetchall()
+                if not only_unanalysed:
+                    # archived messages with ids up to the last row of a full batch belong to this batch
+                    upper_id = rows[-1][0] if len(rows) == batch_size else end_id
+                    archived = self.__archived_rows(conn, next_id, upper_id, batch_size, since, until, role)
+                    if len(archived) > 0:
+                        if not with_time:
+                            archived = [row[:3] for row in archived]
+                        rows = sorted(rows + archived)[:batch_size]
+
+            yield from rows
+
+            if len(rows) < batch_size:
+                return
+            next_id = rows[-1][0] + 1
+            if left is not None:
+                left -= len(rows)
 
     def get_number_of_messages_awaiting_for_analysis(self) -> int:
         """ Returns the number of messages in the memory table that are not analysed yet. """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM memory WHERE analysed = 0")
-        count = cursor.fetchone()[0]
-        cursor.close()
-        return count
+        with self.store.connection("count_awaiting") as conn:
+            return conn.execute("SELECT COUNT(*) FROM memory WHERE analysed = 0").fetchone()[0]
+
+    def stats(self) -> dict:
+        """ Returns sizes of the memory tables and of the database file """
+        with self.store.connection("stats") as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            return {
+                "messages": conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0],
+                "messages_awaiting_analysis": conn.execute("SELECT COUNT(*) FROM memory WHERE analysed = 0").fetchone()[0],
+                "archived_messages": conn.execute("SELECT COALESCE(SUM(rows), 0) FROM memory_archive").fetchone()[0],
+                "archive_segments": conn.execute("SELECT COUNT(*) FROM memory_archive").fetchone()[0],
+                "embedded_messages": conn.execute("SELECT COUNT(*) FROM memory_embeddings").fetchone()[0],
+                "user_profile_keys": conn.execute("SELECT COUNT(*) FROM user_profile").fetchone()[0],
+                "key_topics": conn.execute("SELECT COUNT(*) FROM key_topics").fetchone()[0],
+                "summary_length": len(self.__get_summary(conn)),
+                "partial_summaries": conn.execute("SELECT COUNT(*) FROM summary WHERE reference != ''").fetchone()[0],
+                "generation": self.__get_metadata(conn, "generation") or 0,
+                "database_size_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+                "database_free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+            }
 
     def remember(self, role: str, contents: list | dict | str) -> None:
         """
@@ -92,21 +217,141 @@ class Memory:
             contents (list | dict | str): The content of the message to be stored.
         """
         data = json.dumps(contents)
-        with self.conn:
-            self.conn.execute(
-                "INSERT INTO memory (role, data, analysed) VALUES (?, ?, 0)",
-                (role, data)
+        with self.store.connection("insert") as conn, conn:
+            conn.execute(
+                "INSERT INTO memory (role, data, analysed, created_at) VALUES (?, ?, 0, ?)",
+                (role, data, time.time())
             )
+        self.__notify_remember_listeners(1)
 
-    def recall(self) -> str:
+    def remember_batch(self, messages: list) -> int:
+        """
+        Store many messages in the memory table with one transaction.
+        Args:
+            messages (list): A list of (role, contents) pairs, in the order they have to be stored. A message can also have
+                the time it was created as the third item, ISO 8601 string or seconds since the epoch. It is the current time by default.
+        Returns:
+            int: The number of stored messages.
+        """
+        now = time.time()
+        rows = []
+        for message in messages:
+            created_at = to_timestamp(message[2]) if len(message) > 2 else None
+            rows.append((message[0], json.dumps(message[1]), created_at if created_at is not None else now))
+        if len(rows) == 0:
+            return 0
+        with self.store.connection("insert") as conn, conn:
+            conn.executemany(
+                "INSERT INTO memory (role, data, analysed, created_at) VALUES (?, ?, 0, ?)",
+                rows
+            )
+        self.__notify_remember_listeners(len(rows))
+        return len(rows)
+
+    def import_messages(self, messages, defer_index: bool = False, progress=None) -> int:
+        """
+        Store a stream of messages, for example an exported conversation log, in batches of `import_batch_size` messages.
+        Every batch is stored with one transaction. Batches stored before a failure are kept.
+
+        Args:
+            messages (iterable): (role, contents) or (role, contents, created_at) tuples, in the order they have to be stored. They are read lazily.
+            defer_index (bool): Index the messages for search when all of them are stored instead of one by one, it is several
+                times faster. Messages stored by other processes meanwhile are found by search after the import.
+                The import holds a lease while it runs. If it is killed, the lease expires after `import_lease_ttl` seconds
+                and the index is finished when the database is opened or memories are patched.
+            progress (callable): Called with the number of stored messages after every batch.
+        Returns:
+            int: The number of stored messages.
+        """
+        lease = None
+        if defer_index:
+            lease = Lease(self.store, FTS_IMPORT_LEASE, new_owner_id(), self.config.import_lease_ttl)
+            self.__defer_fts_index(lease)
+
+        count = 0
+        try:
+            batch = []
+            for message in messages:
+                batch.append(message)
+                if len(batch) < self.config.import_batch_size:
+                    continue
+                count += self.remember_batch(batch)
+                batch = []
+                if lease is not None:
+                    # another import can hold it, then the lease is taken when that import ends
+                    lease.acquire()
+                if progress is not None:
+                    progress(count)
+            if len(batch) > 0:
+                count += self.remember_batch(batch)
+                if progress is not None:
+                    progress(count)
+        finally:
+            if lease is not None:
+                self.__finish_fts_index(lease)
+
+        return count
+
+    def export_messages(self, start_id: int = None, end_id: int = None, limit: int = None):
+        """ Stream the messages ordered by id, archived ones included.
+
+        Returns:
+            generator: Yields {"id": ..., "role": ..., "contents": ..., "created_at": ...} dicts. The time is an ISO 8601 string,
+                None for messages stored before the time was kept. import_messages accepts their role, contents and time.
+        """
+        for row_id, role, data, created_at in self.iterate_messages(start_id, end_id, limit, with_time=True):
+            yield {"id": row_id, "role": role, "contents": json.loads(data), "created_at": to_isoformat(created_at)}
+
+    def __defer_fts_index(self, lease: Lease) -> None:
+        """ Stop indexing new messages for search. The messages after the current last one are indexed by __finish_fts_index """
+        lease.acquire()
+        with self.store.connection("import") as conn, conn:
+            conn.execute("""
+                INSERT INTO metadata (key, value) SELECT 'fts_deferred_after', COALESCE(MAX(id), 0) FROM memory WHERE true
+                ON CONFLICT (key) DO NOTHING
+            """)
+            conn.execute("DROP TRIGGER IF EXISTS memory_fts_insert")
+
+    def __finish_fts_index(self, lease: Lease) -> None:
+        """ Index the messages stored since the index was deferred and index new messages one by one again.
+        Nothing is done if another import or process has finished it already """
+        with self.store.connection("import") as conn, conn:
+            self.store.finish_fts_index(conn)
+        lease.release()
+
+    def recall(self, query: str = None, budget: int = None) -> str:
         """
         Recall the memory and return the user profile, key topics, and summary.
+        The text is cached until the memories change.
+
+        With a query or a budget only the parts of the memories that fit the budget are returned. Parts relevant
+        to the query go first, the rest of the budget is filled in the usual order: profile, topics, summary.
+        The parts are returned in a compact format, in the same order every time.
+
+        Args:
+            query (str): Text of the conversation to select the relevant memories for.
+            budget (int): Maximum size of the result in symbols.
         Returns:
             str: A string containing the user profile, key topics, and summary.
         """
-        current_profile = self.__get_user_profile_info()
-        current_key_topics = self.__get_key_topics()
-        summary = self.__get_summary()
+        if query is not None or budget is not None:
+            return self.__recall_fragments(query, budget)
+
+        generation = self.__get_generation()
+        with self.__recall_cache_lock:
+            if self.__recall_cache is not None and self.__recall_cache[0] == generation:
+                return self.__recall_cache[1]
+
+        all_info = self.__render_recall()
+
+        with self.__recall_cache_lock:
+            self.__recall_cache = (generation, all_info)
+
+        return all_info
+
+    def __render_recall(self) -> str:
+        """ Build the recall text from the database """
+        current_profile, current_key_topics, summary = self.__load_memories()
 
         if len(current_profile) == 0 and len(current_key_topics) == 0 and len(summary) == 0:
             return None
@@ -115,197 +360,925 @@ class Memory:
 
         return all_info
 
-    def search(self, data: str) -> str:
+    def __recall_fragments(self, query: str, budget: int) -> str:
+        """ Select the fragments of the memories for the query within the budget and render them """
+        with self.store.connection("recall") as conn:
+            if self.__get_metadata(conn, "fragments_generation") != (self.__get_metadata(conn, "generation") or 0):
+                # the memories were changed by an older version
+                with conn:
+                    self.__rebuild_fragments(conn)
+
+            fragments = conn.execute("SELECT rowid, kind, position, text FROM memory_fragments").fetchall()
+            matched = []
+            fts_query = " OR ".join(self.__fts_query(query or "").split(" "))
+            if fts_query != "":
+                matched = [row[0] for row in conn.execute(
+                    "SELECT rowid FROM memory_fragments WHERE memory_fragments MATCH ? ORDER BY rank", (fts_query,)
+                ).fetchall()]
+
+        if len(fragments) == 0:
+            return None
+
+        kinds = ("profile", "topic", "summary")
+        default_order = sorted(fragments, key=lambda fragment: (kinds.index(fragment[1]), fragment[2]))
+        by_id = {fragment[0]: fragment for fragment in fragments}
+        matched_ids = set(matched)
+        ranked = [by_id[fragment_id] for fragment_id in matched] + [fragment for fragment in default_order if fragment[0] not in matched_ids]
+
+        sections = (("profile", "Profile", "; "), ("topic", "Topics", ", "), ("summary", "Summary", " "))
+        formats = {kind: (title, separator) for kind, title, separator in sections}
+
+        # the first fragment of a section takes the header, and the line break if another section is open already,
+        # other fragments take the separator. The sum does not depend on the order of fragments in the result
+        selected = []
+        opened = set()
+        used = 0
+        for fragment in ranked:
+            title, separator = formats[fragment[1]]
+            if fragment[1] in opened:
+                size = len(separator) + len(fragment[3])
+            else:
+                size = (1 if len(opened) > 0 else 0) + len(title) + 2 + len(fragment[3])
+            if budget is not None and used + size > budget:
+                continue
+            selected.append(fragment)
+            opened.add(fragment[1])
+            used += size
+
+        lines = []
+        for kind, title, separator in sections:
+            texts = [fragment[3] for fragment in sorted(selected, key=lambda fragment: fragment[2]) if fragment[1] == kind]
+            if len(texts) > 0:
+                lines.append(f"{title}: {separator.join(texts)}")
+        result = "\n".join(lines)
+
+        if budget is not None and len(result) > budget:
+            raise RuntimeError(f"Recall of {len(result)} symbols does not fit the budget of {budget}")
+        return result
+
+    def search(self, data: str, limit: int = None, window: int = None, since=None, until=None, role: str = None) -> str:
         """
-        Search for a specific data in the memory table and return surrounding entries.
+        Search for a specific data in the memory table and return surrounding entries of the best matches.
         Args:
             data (str): The data to search for in the memory.
+            limit (int): Maximum number of matches. Config `search_results_limit` by default.
+            window (int): Number of messages to return before and after each match. Config `search_context_window` by default.
+            since, until, role: Filters of the matched messages, see search_hits.
         """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, role, data FROM memory")
-        rows = cursor.fetchall()
-
-        # Search for match and return surrounding entries
-        for i, (row_id, role, content) in enumerate(rows):
-            if data in content:
-                start = max(0, i - 5)
-                end = min(len(rows), i + 6)
-                return '\n'.join(
-                    f"{rows[j][1]}: {rows[j][2]}" for j in range(start, end)
-                )
-        return ''
+        return self.__format_hits(self.search_hits(data, limit, window, since, until, role))
+
+    def search_hits(self, data: str, limit: int = None, window: int = None, since=None, until=None, role: str = None) -> list:
+        """
+        Full-text search over the memory table. Matches are ranked with BM25.
+        Args:
+            data (str): The words to search for. All of them have to be present in a message.
+            limit (int): Maximum number of matches. Config `search_results_limit` by default.
+            window (int): Number of messages to return before and after each match. Config `search_context_window` by default.
+            since (str | float): Match messages stored at this time or later. ISO 8601 string or seconds since the epoch.
+            until (str | float): Match messages stored at this time or earlier.
+            role (str): Match only messages of this role. The messages around a match are returned with any role and time.
+        Returns:
+            list: A list of (match id, context rows) tuples, best match first. Context rows are (id, role, data) tuples ordered by id.
+        """
+        if limit is None:
+            limit = self.config.search_results_limit
+        if window is None:
+            window = self.config.search_context_window
+
+        query = self.__fts_query(data)
+        if query == "" or limit <= 0:
+            return []
+
+        since, until = to_timestamp(since), to_timestamp(until)
+        conditions, filter_params = self.__filter_sql(since, until, role, "m.")
+
+        with self.store.connection("search") as conn:
+            if len(conditions) == 0:
+                matches = conn.execute(
+                    "SELECT rowid FROM memory_fts WHERE memory_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (query, limit)
+                ).fetchall()
+                match_ids = [match_id for (match_id,) in matches]
+            else:
+                match_ids = self.__filtered_matches(conn, query, limit, conditions, filter_params, since, until, role)
+
+            return [(match_id, self.__context_rows(conn, match_id, window)) for match_id in match_ids]
+
+    def __filtered_matches(self, conn, query: str, limit: int, conditions: list, params: list, since: float, until: float, role: str) -> list:
+        """ Ids of the best matches of the full-text query that pass the filters. Matches in the memory table are
+        filtered in the query, archived matches are checked in their segments. Only the id range of messages that can pass
+        the filters is searched """
+        bounds = self.__filtered_id_range(conn, since, until, role, True)
+        if bounds is None:
+            return []
+
+        cursor = conn.execute(f"""
+            SELECT f.rowid, m.id FROM memory_fts f LEFT JOIN memory m ON m.id = f.rowid
+            WHERE memory_fts MATCH ? AND f.rowid BETWEEN ? AND ? AND (m.id IS NULL OR ({' AND '.join(conditions)}))
+            ORDER BY f.rank
+        """, [query, bounds[0], bounds[1]] + params)
+
+        match_ids = []
+        for match_id, memory_id in cursor:
+            if memory_id is None and len(self.__archived_rows(conn, match_id, match_id, 1, since, until, role)) == 0:
+                continue
+            match_ids.append(match_id)
+            if len(match_ids) >= limit:
+                break
+        cursor.close()
+        return match_ids
+
+    def __filtered_id_range(self, conn, since: float, until: float, role: str, with_archive: bool) -> tuple:
+        """ The (first, last) ids of messages that can pass the filters, found with the (role, created_at) index.
+        Archived messages are only checked when they are read. Returns None if no message can pass """
+        conditions, params = self.__filter_sql(since, until, role)
+        first_id, last_id = conn.execute(f"SELECT MIN(id), MAX(id) FROM memory WHERE {' AND '.join(conditions)}", params).fetchone()
+        if with_archive:
+            archive_first_id, archive_last_id = conn.execute("SELECT MIN(first_id), MAX(last_id) FROM memory_archive").fetchone()
+            if archive_first_id is not None:
+                first_id = archive_first_id if first_id is None else min(first_id, archive_first_id)
+                last_id = archive_last_id if last_id is None else max(last_id, archive_last_id)
+        if first_id is None:
+            return None
+        return first_id, last_id
+
+    def __filter_sql(self, since: float, until: float, role: str, prefix: str = "") -> tuple:
+        """ Conditions and parameters of the role and time filters of messages. The (role, created_at) index serves them,
+        unless the prefix is + """
+        conditions = []
+        params = []
+        if role is not None:
+            conditions.append(f"{prefix}role = ?")
+            params.append(role)
+        if since is not None:
+            conditions.append(f"{prefix}created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append(f"{prefix}created_at <= ?")
+            params.append(until)
+        return conditions, params
+
+    def semantic_search(self, query: str, limit: int = None, window: int = None) -> str:
+        """
+        Search for messages with a meaning close to the query and return surrounding entries of the best matches.
+        Args:
+            query (str): The text to search for.
+            limit (int): Maximum number of matches. Config `search_results_limit` by default.
+            window (int): Number of messages to return before and after each match. Config `search_context_window` by default.
+        """
+        return self.__format_hits(self.semantic_search_hits(query, limit, window))
+
+    def semantic_search_hits(self, query: str, limit: int = None, window: int = None) -> list:
+        """
+        Semantic search over the embeddings of the messages. Matches are ranked by cosine similarity.
+        Only messages embedded by the analysis are searched.
+        Returns:
+            list: A list of (match id, context rows) tuples, best match first. Context rows are (id, role, data) tuples ordered by id.
+        """
+        if limit is None:
+            limit = self.config.search_results_limit
+        if window is None:
+            window = self.config.search_context_window
+
+        index = self.__get_vector_index()
+        if index is None:
+            raise RuntimeError("Semantic search is disabled. Set EMBEDDING_BACKEND to enable it")
+
+        matches = index.search(query, limit)
+
+        with self.store.connection("read_context") as conn:
+            return [(match_id, self.__context_rows(conn, match_id, window)) for match_id, _ in matches]
+
+    def __context_rows(self, conn, match_id: int, window: int) -> list:
+        """ Messages around the match, fetched by the id range from the memory table and the archive """
+        rows = conn.execute(
+            "SELECT id, role, data FROM memory WHERE id BETWEEN ? AND ? ORDER BY id",
+            (match_id - window, match_id + window)
+        ).fetchall()
+        archived = self.__archived_rows(conn, match_id - window, match_id + window)
+        if len(archived) > 0:
+            rows = sorted(rows + [row[:3] for row in archived])
+        return rows
+
+    def __archived_rows(self, conn, first_id: int, last_id: int = None, limit: int = None, since: float = None, until: float = None, role: str = None) -> list:
+        """ Archived messages with ids in the range that pass the filters, as (id, role, data, created_at) tuples ordered by id.
+        Segments are read in order until one starts after the range """
+        rows = []
+        cursor = conn.execute("SELECT first_id, data FROM memory_archive WHERE last_id >= ? ORDER BY last_id", (first_id,))
+        for segment_first_id, data in cursor:
+            if last_id is not None and segment_first_id > last_id:
+                break
+            for row in json.loads(zlib.decompress(data)):
+                row_id, row_role, content = row[:3]
+                created_at = row[3] if len(row) > 3 else None
+                if row_id < first_id or (last_id is not None and row_id > last_id):
+                    continue
+                if role is not None and row_role != role:
+                    continue
+                if (since is not None or until is not None) and created_at is None:
+                    continue
+                if (since is not None and created_at < since) or (until is not None and created_at > until):
+                    continue
+                rows.append((row_id, row_role, content, created_at))
+                if limit is not None and len(rows) >= limit:
+                    return rows
+        return rows
+
+    def __format_hits(self, hits: list) -> str:
+        """ Render search hits as text. Hits are separated with --- """
+        return '\n---\n'.join(
+            '\n'.join(f"{role}: {content}" for _, role, content in rows)
+            for _, rows in hits
+        )
+
+    def __fts_query(self, data: str) -> str:
+        """ Build the FTS5 query from the free text. Every word is quoted so it can not break the query syntax """
+        words = re.findall(r"\w+", data)
+        return " ".join(f'"{word}"' for word in words)
     
     def clear(self) -> None:
-        """ Clear all data from the memory tables. """
-        with self.conn:
-            self.conn.execute("DELETE FROM memory")
-            self.conn.execute("DELETE FROM user_profile")
-            self.conn.execute("DELETE FROM key_topics")
-            self.conn.execute("DELETE FROM summary")
-            self.conn.commit()
-            self.conn.execute("VACUUM")
-            self.conn.commit()
-
-    def patch_memories_if_new_data(self):
-        """ Check if there is new data in the memory table and patch it. """
-        print("Checking for new data in the memory table...")
-        if self.get_number_of_messages_awaiting_for_analysis() > self.config.auto_patch_when_num_of_messages_is_greater_then:
-            print("Found new data in the memory table. Patching...")
-            result = self.patch_memories()
-            print(result)
-
-    def patch_memories(self) -> str:
+        """ Clear all data from the memory tables. Free space is released with incremental vacuum.
+        A database created without incremental auto vacuum is vacuumed fully once and switched to it, it is nearly empty now
+        """
+        with self.store.connection("clear") as conn:
+            with conn:
+                conn.execute("DELETE FROM memory")
+                conn.execute("DELETE FROM memory_archive")
+                conn.execute("INSERT INTO memory_fts (memory_fts) VALUES ('delete-all')")
+                conn.execute("DELETE FROM user_profile")
+                conn.execute("DELETE FROM key_topics")
+                conn.execute("DELETE FROM summary")
+                conn.execute("DELETE FROM memory_embeddings")
+                conn.execute("DELETE FROM metadata WHERE key = 'rebuild_last_id'")
+                for table in ("user_profile", "key_topics", "summary"):
+                    conn.execute(f"DROP TABLE IF EXISTS rebuild_{table}")
+                self.__increase_generation(conn)
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # the mode of an existing database only changes with a full vacuum
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+                # the vacuumed database is in the WAL file until it is checkpointed
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                return
+        self.__incremental_vacuum()
+
+    def compact(self) -> str:
+        """ Move analysed messages out of the memory table into the compressed archive.
+
+        The newest `compaction_keep_messages` messages, messages stored in the last `compaction_retention_days` days and
+        messages not analysed yet stay in the memory table. Messages are kept in the order of ids, so the messages after
+        the first one stored within the retention window stay too. Messages stored before the time was kept count as old.
+        Others are moved in segments of `compaction_segment_size` messages, one transaction per segment, so the
+        database is never locked for long. Archived messages stay in the full-text index and keep their embeddings.
+        The released space is returned to the file system with incremental vacuum.
+
+        Returns:
+            str: Log of the compaction.
+        """
+        index = self.__get_vector_index()
+        if index is not None:
+            # messages are embedded from the memory table, so they have to be embedded before they are moved
+            index.index_pending()
+
+        segment_size = max(1, self.config.compaction_segment_size)
+        archived_count = 0
+        segments = 0
+
+        retention_end_id = None
+        if self.config.compaction_retention_days > 0:
+            with self.store.connection("compact") as conn:
+                row = conn.execute(
+                    "SELECT id FROM memory WHERE created_at >= ? ORDER BY id LIMIT 1",
+                    (time.time() - self.config.compaction_retention_days * 86400,)
+                ).fetchone()
+            if row is not None:
+                retention_end_id = row[0] - 1
+
+        while True:
+            with self.store.connection("compact") as conn, conn:
+                # the rows are read in the write transaction, so a compaction running at the same time can not move them too
+                conn.execute("BEGIN IMMEDIATE")
+                max_id = conn.execute("SELECT MAX(id) FROM memory").fetchone()[0] or 0
+                end_id = max_id - self.config.compaction_keep_messages
+                if retention_end_id is not None:
+                    end_id = min(end_id, retention_end_id)
+                rows = conn.execute(
+                    "SELECT id, role, data, created_at FROM memory WHERE analysed = 1 AND id <= ? ORDER BY id LIMIT ?",
+                    (end_id, segment_size)
+                ).fetchall()
+                if len(rows) < segment_size:
+                    break
+
+                # the segment is stored first, so the delete trigger keeps the messages in the full-text index
+                conn.execute(
+                    "INSERT INTO memory_archive (first_id, last_id, rows, data) VALUES (?, ?, ?, ?)",
+                    (rows[0][0], rows[-1][0], len(rows), zlib.compress(json.dumps(rows).encode()))
+                )
+                conn.executemany("DELETE FROM memory WHERE id = ?", [(row[0],) for row in rows])
+
+            archived_count += len(rows)
+            segments += 1
+
+        metrics.inc("compacted_messages_total", archived_count)
+        result_log = f"Archived {archived_count} messages in {segments} segments.\n"
+        if segments > 0:
+            result_log += f"Released {self.__incremental_vacuum()} free pages.\n"
+        return result_log
+
+    def __incremental_vacuum(self) -> int:
+        """ Release free pages of the database in steps of `compaction_vacuum_pages`, so other connections can write between them.
+        Does nothing if the database was created without incremental auto vacuum.
+
+        Returns:
+            int: The number of released pages.
+        """
+        released = 0
+        with self.store.connection("vacuum") as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            while True:
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if free_pages == 0:
+                    return released
+                conn.execute(f"PRAGMA incremental_vacuum({max(1, int(self.config.compaction_vacuum_pages))})")
+                step = free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if step <= 0:
+                    return released
+                released += step
+
+    @metrics.instrument("patch_duration_seconds")
+    def patch_memories(self, limit: int = None, cancel: threading.Event = None) -> str:
         """ Extract data not analysed from the memory table and store it in the user_profile and key_topics tables. 
         This is the main function that will be called to create the memories.
         It will extract the user profile, key topics and summary from the memory table and store it in the user_profile, key_topics and summary tables.
-        """
 
-        analyser = ContextAnalyser(self.config)
+        The results of every chunk of history are saved in one transaction with marking its messages analysed.
+        If the patch fails or is cancelled, the finished chunks are kept and the next patch continues after them.
+        Results of the chunks of a message split between chunks are saved together with its last part, so a message is
+        never saved half analysed.
+
+        Messages are claimed in batches of `claim_batch_size` before they are analysed, so patches running in other threads
+        or processes at the same time analyse other messages. Claims are renewed after every chunk and released when the patch ends.
+        The user profile is merged key by key with the stored one, so changes made by other patches are kept.
+        In the sequential summary mode the summary of the last patch wins, the map-reduce mode keeps the summaries of all of them.
+
+        Args:
+            limit (int): Maximum number of messages to analyse, and of messages to embed for the semantic search. All by default.
+            cancel (threading.Event): When set, the patch stops after the current chunk, or after the last part of a split message.
+                LLM requests that have not started yet are not made and failed ones are not retried, then the results of the
+                current chunk are dropped and its messages are analysed by the next patch.
+        """
 
-        current_profile = self.__get_user_profile_info()
-        current_key_topics = self.__get_key_topics()
-        summary = self.__get_summary()
+        analyser = ContextAnalyser(self.config, cancel)
+        owner = new_owner_id()
 
-        full_history = ""
+        current_profile, known_key_topics, summary = self.__load_memories()
 
         result_log = ""
+        saved_log = []
+        analysed_count = 0
 
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, role, data FROM memory WHERE analysed = 0")
-        rows = cursor.fetchall()
+        # an import with deferred search index that was killed leaves the new messages out of the index
+        with self.store.connection("import") as conn, conn:
+            if self.store.finish_fts_index(conn, abandoned_only=True):
+                result_log += "Search index of an interrupted import is finished.\n"
 
-        result_log += f"Found {len(rows)} unanalysed rows in the memory table.\n"
+        # Messages stored while patching are left for the next patch
+        with self.store.connection("read_history") as conn:
+            last_id = conn.execute("SELECT MAX(id) FROM memory").fetchone()[0] or 0
 
-        for row in rows:
-            row_id, role, content = row
+        rows = self.__claim_messages(owner, last_id, limit)
 
-            # TODO:
-            if role == "user":
-                current_profile = analyser.extract_user_profile_info(content, current_profile)
+        map_reduce = self.config.summary_mode == "map_reduce"
+        if map_reduce:
+            self.__seed_summary_leaves()
 
-            full_history += f"{role}: {content}\n\n"
+        chunker = self.__chunker()
+        chunks = chunker.chunks(rows, lambda: chunker.state_tokens(known_key_topics, None if map_reduce else summary))
 
-            if len(full_history) > self.config.summarizer_request_max_length:
-                current_key_topics = analyser.extract_key_topics(full_history, current_key_topics)
-                summary = analyser.extract_summary(full_history, summary)
-                full_history = ""
+        try:
+            with ExtractionPipeline(self.config, analyser) as pipeline:
+                base_profile = current_profile
+                pending_topics = {}
+                pending_leaves = []
+                pending_ids = []
+                for chunk, leaf_summary in self.__analysis_chunks(pipeline, chunks):
+                    current_profile, chunk_key_topics, summary = pipeline.extract(
+                        chunk.history, chunk.user_messages, current_profile, known_key_topics, None if map_reduce else summary
+                    )
+                    known_key_topics = self.__known_key_topics(known_key_topics, chunk_key_topics)
+                    merge_topics(pending_topics, chunk_key_topics)
+                    if leaf_summary is not None:
+                        pending_leaves.append((chunk.row_ids, leaf_summary.result()))
+                    pending_ids.extend(chunk.done_ids)
 
-            # update the analysed field to 1
-            cursor.execute("UPDATE memory SET analysed = 1 WHERE id = ?", (row_id,))
-            self.conn.commit()
-        cursor.close()
+                    if not chunk.complete:
+                        # the message continues in the next chunk. Its parts are saved together with the last one
+                        with self.store.connection("claim_messages") as conn, conn:
+                            self.__renew_claims(conn, owner)
+                        continue
+
+                    with self.store.connection("save_memories") as conn, conn:
+                        saved_log.append(self.__save_memories(conn, current_profile, pending_topics, summary, base_profile=base_profile))
+                        for row_ids, leaf in pending_leaves:
+                            self.__save_summary_leaf(conn, row_ids, leaf)
+                        # update the analysed field to 1. A message split between chunks is marked with its last part
+                        conn.executemany(
+                            "UPDATE memory SET analysed = 1, claimed_by = NULL, claim_expires = NULL WHERE id = ?",
+                            [(row_id,) for row_id in pending_ids]
+                        )
+                        self.__renew_claims(conn, owner)
+                        # the next chunk continues from the profile with the changes of other patches
+                        current_profile = self.__get_user_profile_info(conn)
+                    analysed_count += len(pending_ids)
+                    base_profile = current_profile
+                    pending_topics = {}
+                    pending_leaves = []
+                    pending_ids = []
 
-        if len(full_history) > 0:
-            current_key_topics = analyser.extract_key_topics(full_history, current_key_topics)
-            summary = analyser.extract_summary(full_history, summary)
+                    if cancel is not None and cancel.is_set():
+                        result_log += "Patch cancelled.\n"
+                        break
+                else:
+                    if map_reduce:
+                        summary = self.__reduce_summaries(pipeline)
+                        with self.store.connection("save_memories") as conn, conn:
+                            saved_log.append(self.__save_memories(conn, current_profile, {}, summary, base_profile=current_profile))
+        except CancelledError:
+            result_log += "Patch cancelled.\n"
+        finally:
+            self.__release_claims(owner)
+
+        result_log += f"Found {analysed_count} unanalysed rows in the memory table.\n"
+        metrics.inc("patch_messages_total", analysed_count)
+        # every update is reported once
+        result_log += "".join(dict.fromkeys(line + "\n" for log in saved_log for line in log.splitlines()))
+
+        index = self.__get_vector_index()
+        if index is not None and not (cancel is not None and cancel.is_set()):
+            # the history of a database where the semantic search was just enabled is embedded over several patches
+            result_log += f"Embedded {index.index_pending(limit)} messages.\n"
+
+        return result_log
+    
+    def __claim_messages(self, owner: str, end_id: int, limit: int = None):
+        """ Claim pending messages for the owner in batches of `claim_batch_size`, lazily.
+        Messages claimed by other owners are skipped until their claims expire.
+
+        Returns:
+            generator: Yields (id, role, data) tuples, ordered by id within a batch.
+        """
+        left = limit
+        while left is None or left > 0:
+            batch_size = self.config.claim_batch_size
+            if left is not None:
+                batch_size = min(batch_size, left)
+
+            now = time.time()
+            with self.store.connection("claim_messages") as conn, conn:
+                rows = conn.execute("""
+                    UPDATE memory SET claimed_by = ?, claim_expires = ?
+                    WHERE id IN (
+                        SELECT id FROM memory
+                        WHERE analysed = 0 AND id <= ? AND (claimed_by IS NULL OR claim_expires < ?)
+                        ORDER BY id LIMIT ?
+                    )
+                    RETURNING id, role, data
+                """, (owner, now + self.config.claim_ttl, end_id, now, batch_size)).fetchall()
+
+            # RETURNING does not keep the order
+            yield from sorted(rows)
+
+            if len(rows) < batch_size:
+                return
+            if left is not None:
+                left -= len(rows)
+
+    def __renew_claims(self, conn, owner: str) -> None:
+        """ Extend the claims of the owner on the messages it did not analyse yet """
+        conn.execute(
+            "UPDATE memory SET claim_expires = ? WHERE claimed_by = ? AND analysed = 0",
+            (time.time() + self.config.claim_ttl, owner)
+        )
+
+    def __release_claims(self, owner: str) -> None:
+        """ Return the messages claimed by the owner and not analysed to the pending ones """
+        with self.store.connection("claim_messages") as conn, conn:
+            conn.execute("UPDATE memory SET claimed_by = NULL, claim_expires = NULL WHERE claimed_by = ? AND analysed = 0", (owner,))
+
+    def __notify_remember_listeners(self, count: int) -> None:
+        """ Tell the listeners that `count` messages were stored """
+        for listener in self.__remember_listeners:
+            listener(count)
+
+    def __chunker(self) -> HistoryChunker:
+        """ Chunker for the history sent to the key topics and summary models """
+        return HistoryChunker(self.config, [self.config.extractor_model, self.config.summarizer_model])
+
+    def __known_key_topics(self, known_key_topics: dict, chunk_key_topics: dict) -> dict:
+        """ Known topics for the next chunk: the most mentioned of the known topics and the topics of the last chunk """
+        return top_topics(merge_topics(dict(known_key_topics), chunk_key_topics), self.config.key_topics_context_size)
+
+    def __analysis_chunks(self, pipeline: ExtractionPipeline, chunks):
+        """ Chunks of history to analyse. In the map-reduce summary mode every chunk comes with the future of its own summary 
+
+        Returns:
+            generator: Yields (chunk, summary future or None) for each chunk.
+        """
+        if self.config.summary_mode == "map_reduce":
+            yield from pipeline.prefetch_summaries(chunks)
+            return
+        for chunk in chunks:
+            yield chunk, None
+
+    def __save_summary_leaf(self, conn, row_ids: list, summary: str, prefix: str = "") -> None:
+        """ Store the summary of one chunk. The reference is leaf:<first id>-<last id> """
+        conn.execute(
+            f"INSERT INTO {prefix}summary (reference, summary) VALUES (?, ?)",
+            (f"leaf:{row_ids[0]}-{row_ids[-1]}", summary)
+        )
+
+    def __seed_summary_leaves(self) -> None:
+        """ When the map-reduce mode is used on memories built sequentially, the current summary becomes the first leaf """
+        with self.store.connection("save_summary") as conn, conn:
+            if conn.execute("SELECT 1 FROM summary WHERE reference LIKE 'leaf:%' LIMIT 1").fetchone():
+                return
+            summary = self.__get_summary(conn)
+            if summary == "":
+                return
+            last_id = conn.execute("SELECT MAX(id) FROM memory WHERE analysed = 1").fetchone()[0] or 0
+            self.__save_summary_leaf(conn, [0, last_id], summary)
+
+    def __reduce_summaries(self, pipeline: ExtractionPipeline, prefix: str = "") -> str:
+        """ Merge the chunk summaries into one summary.
+
+        Leaves are grouped by `summary_merge_fan_in` in the order of messages, every group is merged into a node of
+        the next level, and so on until one summary is left. Nodes are stored with the reference node:<level>:<position>:<first id>-<last id>,
+        the position of the group in its level tells groups apart when they have the same range, like parts of a split message.
+        Groups are fixed by position, so new leaves only change the last node of every level. Other nodes are loaded from the database.
+        Merges of one level run in parallel.
+
+        Returns:
+            str: The summary of all leaves.
+        """
+        with self.store.connection("read_summary") as conn:
+            rows = conn.execute(f"SELECT reference, summary FROM {prefix}summary WHERE reference != '' ORDER BY id").fetchall()
+
+        leaves = []
+        nodes = {}
+        for reference, text in rows:
+            kind, _, id_range = reference.partition(":")
+            if kind == "leaf":
+                first_id, last_id = id_range.split("-")
+                leaves.append((int(first_id), int(last_id), text))
+            elif kind == "node":
+                nodes[reference] = text
+        # parts of a message split between chunks have the same range. They stay in the order they were stored
+        leaves.sort(key=lambda leaf: leaf[:2])
+
+        fan_in = max(2, self.config.summary_merge_fan_in)
+        items = leaves
+        level = 1
+        used_nodes = set()
+        new_nodes = {}
+
+        while len(items) > 1:
+            next_items = []
+            for i in range(0, len(items), fan_in):
+                group = items[i:i + fan_in]
+                if len(group) == 1:
+                    next_items.append(group[0])
+                    continue
+
+                first_id, last_id = group[0][0], group[-1][1]
+                reference = f"node:{level}:{i // fan_in}:{first_id}-{last_id}"
+                used_nodes.add(reference)
+                if reference in nodes:
+                    next_items.append((first_id, last_id, nodes[reference]))
+                    continue
+
+                future = pipeline.submit(pipeline.analyser.merge_summaries, [text for _, _, text in group])
+                new_nodes[reference] = future
+                next_items.append((first_id, last_id, future))
+
+            items = [
+                (first_id, last_id, text.result() if isinstance(text, Future) else text)
+                for first_id, last_id, text in next_items
+            ]
+            level += 1
+
+        with self.store.connection("save_summary") as conn, conn:
+            conn.executemany(
+                f"INSERT INTO {prefix}summary (reference, summary) VALUES (?, ?)",
+                [(reference, future.result()) for reference, future in new_nodes.items()]
+            )
+            conn.executemany(
+                f"DELETE FROM {prefix}summary WHERE reference = ?",
+                [(reference,) for reference in nodes if reference not in used_nodes]
+            )
 
-        # Sync the user profile with the database
-        if self.__sync_user_profile(current_profile):
+        if len(items) == 0:
+            return ""
+        return items[0][2]
+
+    def __get_vector_index(self) -> VectorIndex:
+        """ The index for the semantic search. It is created on first use. Returns None if embeddings are disabled """
+        with self.__vector_index_lock:
+            if self.__vector_index is None:
+                embedder = create_embedder(self.config)
+                if embedder is None:
+                    return None
+                self.__vector_index = VectorIndex(self.store, embedder, self.config.embedding_batch_size)
+            return self.__vector_index
+
+    def __get_generation(self) -> int:
+        """ Load the generation of the memories. It changes every time the memories are updated """
+        with self.store.connection("read_metadata") as conn:
+            return self.__get_metadata(conn, "generation") or 0
+
+    def __increase_generation(self, conn) -> None:
+        """ Mark the memories as changed and rebuild their fragments. Must be called inside the transaction that changes them """
+        conn.execute("""
+            INSERT INTO metadata (key, value) VALUES ('generation', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1
+        """)
+        self.__rebuild_fragments(conn)
+
+    def __rebuild_fragments(self, conn) -> None:
+        """ Split the memories into fragments for the query-scoped recall. Must be called inside a transaction """
+        rows = []
+        for position, (key, data) in enumerate(sorted(self.__get_user_profile_info(conn).items())):
+            value = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+            rows.append(("profile", position, f"{key}: {value}"))
+
+        for position, (topic, count) in enumerate(self.__get_key_topics(conn, "", self.config.key_topics_context_size).items()):
+            rows.append(("topic", position, f"{topic} ({count})"))
+
+        segment = ""
+        position = 0
+        for sentence in SENTENCE_END.split(self.__get_summary(conn)):
+            if segment != "" and len(segment) + len(sentence) + 1 > self.config.recall_summary_segment_length:
+                rows.append(("summary", position, segment))
+                segment = ""
+                position += 1
+            segment = sentence if segment == "" else f"{segment} {sentence}"
+        if segment.strip() != "":
+            rows.append(("summary", position, segment))
+
+        conn.execute("DELETE FROM memory_fragments")
+        conn.executemany("INSERT INTO memory_fragments (kind, position, text) VALUES (?, ?, ?)", rows)
+        conn.execute("""
+            INSERT INTO metadata (key, value) VALUES ('fragments_generation', COALESCE((SELECT value FROM metadata WHERE key = 'generation'), 0))
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        """)
+
+    def __load_memories(self, prefix: str = "") -> tuple:
+        """ Load the user profile, the most mentioned key topics and summary with one connection.
+
+        Args:
+            prefix (str): Prefix of the tables. Empty for the live memories, `rebuild_` for the memories being rebuilt.
+
+        Returns:
+            tuple: (user profile, key topics, summary)
+        """
+        with self.store.connection("load_memories") as conn:
+            return (
+                self.__get_user_profile_info(conn, prefix),
+                self.__get_key_topics(conn, prefix, self.config.key_topics_context_size),
+                self.__get_summary(conn, prefix),
+            )
+
+    def __save_memories(self, conn, user_profile: dict, new_key_topics: dict, summary: str, prefix: str = "", base_profile: dict = None) -> str:
+        """ Sync the user profile and summary with the database and add the counts of new key topics. Must be called inside a transaction.
+        When the profile the user profile was made from is given, only the keys changed since it are saved.
+
+        Returns:
+            str: Log of what was updated.
+        """
+        result_log = ""
+
+        if base_profile is not None:
+            if self.__merge_user_profile(conn, base_profile, user_profile, prefix):
+                result_log += "User profile updated.\n"
+        elif self.__sync_user_profile(conn, user_profile, prefix):
             result_log += "User profile updated.\n"
 
-        # Sync the key topics with the database
-        if self.__sync_key_topics(current_key_topics):
+        if self.__add_key_topics(conn, new_key_topics, prefix):
             result_log += "Key topics updated.\n"
 
-        # Sync the summary with the database
-        if self.__sync_summary(summary):
+        if summary is not None and self.__sync_summary(conn, summary, prefix):
             result_log += "Summary updated.\n"
 
+        if result_log != "" and prefix == "":
+            self.__increase_generation(conn)
+
         return result_log
-    
-    def __get_user_profile_info(self) -> dict:
+
+    def __get_user_profile_info(self, conn, prefix: str = "") -> dict:
         """ Load current user profile data from the database. """ 
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT key, data FROM user_profile")
-        rows = cursor.fetchall()
+        rows = conn.execute(f"SELECT key, data FROM {prefix}user_profile").fetchall()
         user_profile = {}
         for row in rows:
             key, data = row
             user_profile[key] = json.loads(data)
         return user_profile
     
-    def __get_key_topics(self) -> dict:
-        """ Load current key topics data from the database. """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT topic, count FROM key_topics")
-        rows = cursor.fetchall()
+    def __get_key_topics(self, conn, prefix: str = "", limit: int = None) -> dict:
+        """ Load key topics from the database, most mentioned first. """
+        query = f"SELECT topic, count FROM {prefix}key_topics ORDER BY count DESC, topic"
+        params = ()
+        if limit is not None:
+            query += " LIMIT ?"
+            params = (limit,)
+        rows = conn.execute(query, params).fetchall()
         key_topics = {}
         for row in rows:
             topic, count = row
             key_topics[topic] = count
         return key_topics
     
-    def __get_summary(self) -> str:
+    def __get_summary(self, conn, prefix: str = "") -> str:
         """ Load current summary data from the database. """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT summary FROM summary")
-        row = cursor.fetchone()
+        row = conn.execute(f"SELECT summary FROM {prefix}summary WHERE reference = '' ORDER BY id DESC LIMIT 1").fetchone()
         if row:
             return row[0]
         return ""
     
-    def __sync_user_profile(self, user_profile: dict) -> bool:
+    def __sync_user_profile(self, conn, user_profile: dict, prefix: str = "") -> bool:
         """ Sync the user profile data with the database. """
-        current_profile = self.__get_user_profile_info()
+        current_profile = self.__get_user_profile_info(conn, prefix)
 
         # if identical - do nothing
         if current_profile == user_profile:
             return False
 
-        cursor = self.conn.cursor()
         for key, data in user_profile.items():
-            cursor.execute("INSERT OR REPLACE INTO user_profile (key, data) VALUES (?, ?)", (key, json.dumps(data)))
+            conn.execute(f"INSERT OR REPLACE INTO {prefix}user_profile (key, data) VALUES (?, ?)", (key, json.dumps(data)))
             if key in current_profile:
                 del current_profile[key] 
-        self.conn.commit()
 
         # Remove keys that are not in the new profile
         for key in current_profile.keys():
-            cursor.execute("DELETE FROM user_profile WHERE key = ?", (key,))
-            self.conn.commit()
+            conn.execute(f"DELETE FROM {prefix}user_profile WHERE key = ?", (key,))
 
         return True
 
-    def __sync_key_topics(self, key_topics: dict) -> bool:
-        """ Sync the key topics data with the database. """
-        current_key_topics = self.__get_key_topics()
+    def __merge_user_profile(self, conn, base_profile: dict, user_profile: dict, prefix: str = "") -> bool:
+        """ Save the keys changed in the user profile since the base profile.
+        A removed key is only deleted if nobody changed it in the database since the base profile was loaded """
+        changed = False
 
-        # if identical - do nothing
-        if current_key_topics == key_topics:
-            return False
+        for key, data in user_profile.items():
+            if key in base_profile and base_profile[key] == data:
+                continue
+            conn.execute(f"""
+                INSERT INTO {prefix}user_profile (key, data) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET data = excluded.data
+            """, (key, json.dumps(data)))
+            changed = True
 
-        cursor = self.conn.cursor()
-        for topic, count in key_topics.items():
-            cursor.execute("INSERT OR REPLACE INTO key_topics (topic, count) VALUES (?, ?)", (topic, count))
-            if topic in current_key_topics:
-                del current_key_topics[topic]
-        self.conn.commit()
+        for key, data in base_profile.items():
+            if key in user_profile:
+                continue
+            cursor = conn.execute(f"DELETE FROM {prefix}user_profile WHERE key = ? AND data = ?", (key, json.dumps(data)))
+            changed = changed or cursor.rowcount > 0
 
-        # Remove keys that are not in the new profile
-        for topic in current_key_topics.keys():
-            cursor.execute("DELETE FROM key_topics WHERE topic = ?", (topic,))
-            self.conn.commit()
+        return changed
+
+    def __add_key_topics(self, conn, new_key_topics: dict, prefix: str = "") -> bool:
+        """ Add counts of new key topics to the database. Topics must be normalized. """
+        if len(new_key_topics) == 0:
+            return False
+
+        conn.executemany(f"""
+            INSERT INTO {prefix}key_topics (topic, count) VALUES (?, ?)
+            ON CONFLICT (topic) DO UPDATE SET count = count + excluded.count
+        """, new_key_topics.items())
 
         return True
 
-    def __sync_summary(self, summary: str) -> bool:
-        """ Sync the summary data with the database. """
-        current_summary = self.__get_summary()
+    def __sync_summary(self, conn, summary: str, prefix: str = "") -> bool:
+        """ Sync the summary data with the database. The summary is the only row with empty reference """
+        current_summary = self.__get_summary(conn, prefix)
         # if identical - do nothing
         if current_summary == summary:
             return False
-        print(f"Summary: {summary}")
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO summary (reference,summary) VALUES (?,?)", ("", summary))
-        self.conn.commit()
+        if prefix == "":
+            print(f"Summary: {summary}")
+        conn.execute(f"DELETE FROM {prefix}summary WHERE reference = ''")
+        conn.execute(f"INSERT INTO {prefix}summary (reference, summary) VALUES (?, ?)", ("", summary))
+        if self.config.summary_mode != "map_reduce":
+            # partial summaries of the map-reduce mode are outdated now
+            conn.execute(f"DELETE FROM {prefix}summary WHERE reference != ''")
 
         return True
-        
-    def rebuild_memories(self) -> None:
-        """ Rebuild the memories from the memory table. """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, role, data FROM memory")
-        rows = cursor.fetchall()
 
-        for row in rows:
-            row_id, role, content = row
\ No newline at end of file
+    @metrics.instrument("rebuild_duration_seconds")
+    def rebuild_memories(self, cancel: threading.Event = None) -> str:
+        """ Rebuild the memories from the full memory table.
+
+        All messages are analysed again, chunk by chunk, into the shadow tables rebuild_user_profile, rebuild_key_topics and rebuild_summary.
+        After every chunk the shadow tables and the id of the last processed message are committed together, so an interrupted
+        rebuild continues from the last chunk when it is started again. Recall keeps returning the current memories until 
+        the rebuild is finished. Then the shadow tables replace them in one transaction.
+
+        Args:
+            cancel (threading.Event): When set, the rebuild stops after the current chunk, or after the last part of a split message. It continues from there when started again.
+                LLM requests that have not started yet are not made, the rebuild continues from the last saved chunk then.
+        """
+        result_log = ""
+
+        with self.store.connection("rebuild") as conn, conn:
+            last_id = self.__get_metadata(conn, "rebuild_last_id")
+            if last_id is None:
+                last_id = 0
+                self.__create_rebuild_tables(conn)
+                conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('rebuild_last_id', 0)")
+            else:
+                result_log += f"Resuming the rebuild after message {last_id}.\n"
+
+        current_profile, known_key_topics, summary = self.__load_memories("rebuild_")
+        analysed_count = 0
+
+        analyser = ContextAnalyser(self.config, cancel)
+
+        map_reduce = self.config.summary_mode == "map_reduce"
+        rows = self.iterate_messages(start_id=last_id + 1)
+        chunker = self.__chunker()
+        chunks = chunker.chunks(rows, lambda: chunker.state_tokens(known_key_topics, None if map_reduce else summary))
+
+        try:
+            with ExtractionPipeline(self.config, analyser) as pipeline:
+                pending_topics = {}
+                pending_leaves = []
+                pending_ids = []
+                for chunk, leaf_summary in self.__analysis_chunks(pipeline, chunks):
+                    current_profile, chunk_key_topics, summary = pipeline.extract(
+                        chunk.history, chunk.user_messages, current_profile, known_key_topics, None if map_reduce else summary
+                    )
+                    known_key_topics = self.__known_key_topics(known_key_topics, chunk_key_topics)
+                    merge_topics(pending_topics, chunk_key_topics)
+                    if leaf_summary is not None:
+                        pending_leaves.append((chunk.row_ids, leaf_summary.result()))
+                    pending_ids.extend(chunk.done_ids)
+
+                    if not chunk.complete:
+                        # a message split between chunks is checkpointed with its last part
+                        continue
+
+                    if len(pending_ids) > 0:
+                        last_id = pending_ids[-1]
+                    with self.store.connection("rebuild") as conn, conn:
+                        self.__save_memories(conn, current_profile, pending_topics, summary, "rebuild_")
+                        for row_ids, leaf in pending_leaves:
+                            self.__save_summary_leaf(conn, row_ids, leaf, "rebuild_")
+                        conn.execute("UPDATE metadata SET value = ? WHERE key = 'rebuild_last_id'", (last_id,))
+
+                    analysed_count += len(pending_ids)
+                    pending_topics = {}
+                    pending_leaves = []
+                    pending_ids = []
+
+                    if cancel is not None and cancel.is_set():
+                        return result_log + f"Analysed {analysed_count} rows. Rebuild cancelled after message {last_id}.\n"
+
+                if map_reduce:
+                    summary = self.__reduce_summaries(pipeline, "rebuild_")
+                    with self.store.connection("rebuild") as conn, conn:
+                        self.__sync_summary(conn, summary, "rebuild_")
+        except CancelledError:
+            return result_log + f"Analysed {analysed_count} rows. Rebuild cancelled after message {last_id}.\n"
+
+        result_log += f"Analysed {analysed_count} rows.\n"
+
+        with self.store.connection("rebuild") as conn, conn:
+            for table in ("user_profile", "key_topics", "summary"):
+                conn.execute(f"DELETE FROM {table}")
+                conn.execute(f"INSERT INTO {table} SELECT * FROM rebuild_{table}")
+                conn.execute(f"DROP TABLE rebuild_{table}")
+
+            # Messages stored after the rebuild finished are analysed by the next patch into the new memories
+            conn.execute("UPDATE memory SET analysed = 1 WHERE id <= ? AND analysed = 0", (last_id,))
+            conn.execute("UPDATE memory SET analysed = 0 WHERE id > ? AND analysed = 1", (last_id,))
+
+            conn.execute("DELETE FROM metadata WHERE key = 'rebuild_last_id'")
+            self.__increase_generation(conn)
+
+        result_log += "Memories replaced with the rebuilt ones.\n"
+
+        return result_log
+
+    def __create_rebuild_tables(self, conn) -> None:
+        """ Create empty shadow tables for the rebuild with the same columns as the memories tables """
+        for table in ("user_profile", "key_topics", "summary"):
+            conn.execute(f"DROP TABLE IF EXISTS rebuild_{table}")
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+            conn.execute(sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE rebuild_{table}", 1))
+        self.store._migrate_key_topics(conn, "rebuild_key_topics")
+
+    def __get_metadata(self, conn, key: str) -> int:
+        """ Load a value from the metadata table. Returns None if it is not set """
+        row = conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        if row:
+            return row[0]
+        return None
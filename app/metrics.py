@@ -0,0 +1,133 @@
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+class Histogram:
+    """ Cumulative histogram of observed values """
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Metrics:
+    """
+    Registry of counters, gauges and histograms of the process.
+
+    Every metric has a name and optional labels. The registry can be rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__types = {} # name -> counter, gauge or histogram
+        self.__values = {} # (name, labels) -> number or Histogram
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """ Increase a counter """
+        key = self.__key(name, "counter", labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """ Set a gauge """
+        key = self.__key(name, "gauge", labels)
+        with self.__lock:
+            self.__values[key] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels) -> None:
+        """ Add a value to a histogram """
+        key = self.__key(name, "histogram", labels)
+        with self.__lock:
+            histogram = self.__values.get(key)
+            if histogram is None:
+                histogram = Histogram(buckets)
+                self.__values[key] = histogram
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        """ Observe the duration of the block in seconds. Failed blocks are counted in <name without _duration_seconds>_errors_total """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name.removesuffix('_duration_seconds')}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def instrument(self, name: str, **labels):
+        """ Decorator that observes the duration of every call of the function. Coroutine functions are timed until they finish """
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timed(name, **labels):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timed(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> dict:
+        """ Current values. Histograms are reported with their count and sum """
+        result = {}
+        with self.__lock:
+            for (name, labels), value in sorted(self.__values.items()):
+                label_text = self.__labels_text(labels)
+                if isinstance(value, Histogram):
+                    result[f"{name}_count{label_text}"] = value.count
+                    result[f"{name}_sum{label_text}"] = value.sum
+                else:
+                    result[f"{name}{label_text}"] = value
+        return result
+
+    def render(self) -> str:
+        """ All metrics in the Prometheus text format """
+        lines = []
+        with self.__lock:
+            by_name = {}
+            for (name, labels), value in self.__values.items():
+                by_name.setdefault(name, []).append((labels, value))
+
+            for name in sorted(by_name):
+                lines.append(f"# TYPE {name} {self.__types[name]}")
+                for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                    if isinstance(value, Histogram):
+                        for bound, count in zip(value.buckets, value.counts):
+                            lines.append(f"{name}_bucket{self.__labels_text(labels + (('le', str(bound)),))} {count}")
+                        lines.append(f"{name}_bucket{self.__labels_text(labels + (('le', '+Inf'),))} {value.count}")
+                        lines.append(f"{name}_sum{self.__labels_text(labels)} {value.sum}")
+                        lines.append(f"{name}_count{self.__labels_text(labels)} {value.count}")
+                    else:
+                        lines.append(f"{name}{self.__labels_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def __key(self, name: str, metric_type: str, labels: dict) -> tuple:
+        """ Registry key of the metric. Remembers the type of the metric """
+        self.__types.setdefault(name, metric_type)
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def __labels_text(self, labels: tuple) -> str:
+        if len(labels) == 0:
+            return ""
+        values = ",".join(f'{key}="{value}"' for key, value in labels)
+        return "{" + values + "}"
+
+# Metrics of the process
+metrics = Metrics()
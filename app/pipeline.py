@@ -0,0 +1,86 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .config import Config
+from .analyser import ContextAnalyser
+
+class ExtractionPipeline:
+    """
+    Runs the user profile, key topics and summary extraction of a chunk of history concurrently.
+
+    The three extractions do not depend on each other, so their LLM requests can overlap.
+    Each of them still sees the results of the previous chunk, so the results are the same as with sequential processing.
+    """
+    def __init__(self, config: Config, analyser: ContextAnalyser):
+        """
+        Args:
+            config (Config): Configuration object. `analyser_concurrency` limits the number of parallel LLM requests.
+            analyser (ContextAnalyser): The analyser to make the requests with.
+        """
+        self.config = config
+        self.analyser = analyser
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max(1, config.analyser_concurrency),
+            thread_name_prefix="analyser",
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """ Stop the worker threads. Requests that have not started yet, like summaries prefetched for chunks that are not needed, are cancelled. """
+        self.__executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, fn, *args) -> Future:
+        """ Run a function in the pipeline threads. """
+        return self.__executor.submit(fn, *args)
+
+    def prefetch_summaries(self, chunks):
+        """
+        Summarize chunks of history independently of each other, ahead of the chunk being processed.
+        Up to `analyser_concurrency` chunks are summarized in advance.
+        Args:
+            chunks (iterable): Chunk objects.
+        Returns:
+            generator: Yields (chunk, summary future) in the order of chunks.
+        """
+        chunks = iter(chunks)
+        pending = deque()
+
+        while True:
+            while len(pending) < max(1, self.config.analyser_concurrency):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append((chunk, self.submit(self.analyser.extract_summary, chunk.history, "")))
+
+            if len(pending) == 0:
+                return
+            yield pending.popleft()
+
+    def extract(self, history: str, user_messages: list, profile: dict, key_topics: dict, summary: str) -> tuple:
+        """
+        Extract new profile, key topics of the chunk and summary from a chunk of history.
+        Args:
+            history (str): The chunk of the conversation.
+            user_messages (list): Messages of the user in the chunk, in order. They are used for the profile.
+            profile (dict): The current user profile.
+            key_topics (dict): Known key topics. They are sent as a hint for naming of topics.
+            summary (str): The current summary. None to skip the summary extraction.
+        Returns:
+            tuple: (profile, key topics found in the chunk with their counts, summary)
+        """
+        profile_future = self.__executor.submit(self.analyser.extract_user_profile_info_batch, user_messages, profile)
+        key_topics_future = self.__executor.submit(self.analyser.extract_key_topics, history, key_topics)
+        summary_future = None
+        if summary is not None:
+            summary_future = self.__executor.submit(self.analyser.extract_summary, history, summary)
+
+        return (
+            profile_future.result(),
+            key_topics_future.result(),
+            summary_future.result() if summary_future is not None else None,
+        )
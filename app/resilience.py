@@ -0,0 +1,115 @@
+import random
+import threading
+import time
+
+from .config import Config
+from .metrics import metrics
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling a service that failed too many times in a row """
+
+class CancelledError(Exception):
+    """ Raised instead of calling a service after the work that needs the call was cancelled """
+
+class CircuitBreaker:
+    """
+    Stops calls to a service after `failure_threshold` failures in a row.
+
+    While the circuit is open, calls fail at once with CircuitOpenError. After `reset_timeout` seconds calls
+    are let through again. The first success closes the circuit, the first failure opens it for another period.
+    """
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        """
+        Args:
+            name (str): Name of the service, used in errors and metrics.
+            failure_threshold (int): Failures in a row that open the circuit.
+            reset_timeout (float): Seconds the circuit stays open before calls are tried again.
+        """
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened_at = None
+
+    def retry_at(self) -> float:
+        """ Monotonic time when calls are allowed again. None if the circuit is closed """
+        with self.__lock:
+            if self.__opened_at is None:
+                return None
+            return self.__opened_at + self.reset_timeout
+
+    def before_call(self) -> None:
+        """ Check that a call is allowed. Raises CircuitOpenError if it is not """
+        with self.__lock:
+            if self.__opened_at is None:
+                return
+            if time.monotonic() < self.__opened_at + self.reset_timeout:
+                raise CircuitOpenError(f"{self.name} is unavailable after {self.__failures} failures in a row")
+
+    def record_success(self) -> None:
+        with self.__lock:
+            self.__failures = 0
+            self.__opened_at = None
+        metrics.set("circuit_open", 0, service=self.name)
+
+    def record_failure(self) -> None:
+        with self.__lock:
+            self.__failures += 1
+            if self.__opened_at is None and self.__failures < self.failure_threshold:
+                return
+            self.__opened_at = time.monotonic()
+        metrics.set("circuit_open", 1, service=self.name)
+
+def call_with_retries(fn, retries: int, backoff: float, breaker: CircuitBreaker = None, retryable=None, cancel: threading.Event = None):
+    """
+    Call the function, retrying failures with exponential backoff and jitter.
+
+    Args:
+        fn (callable): The function to call, without arguments.
+        retries (int): Retries after the first failure.
+        backoff (float): Seconds before the first retry. Doubled for every next one.
+        breaker (CircuitBreaker): Breaker of the called service. Every attempt is recorded in it.
+        retryable (callable): Tells if an exception is worth retrying. All exceptions are by default.
+        cancel (threading.Event): When set, the function is not called or retried, CancelledError is raised instead.
+            The wait before a retry ends as soon as it is set.
+    Returns:
+        The result of the function.
+    """
+    attempt = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise CancelledError("The call is cancelled")
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = fn()
+        except Exception as e:
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt >= retries or (retryable is not None and not retryable(e)):
+                raise
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+            attempt += 1
+            metrics.inc("retries_total", service=breaker.name if breaker is not None else "")
+            if cancel is None:
+                time.sleep(delay)
+            elif cancel.wait(delay):
+                raise CancelledError("The call is cancelled") from e
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_llm_circuit_breaker(config: Config) -> CircuitBreaker:
+    """ Returns the process-wide circuit breaker of the LLM service """
+    with _breakers_lock:
+        breaker = _breakers.get("llm")
+        if breaker is None:
+            breaker = CircuitBreaker("llm", config.llm_circuit_failure_threshold, config.llm_circuit_reset_timeout)
+            _breakers["llm"] = breaker
+        return breaker
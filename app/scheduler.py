@@ -0,0 +1,281 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .config import Config
+from .leases import Lease, new_owner_id
+from .metrics import metrics
+from .resilience import CircuitOpenError, get_llm_circuit_breaker
+from .store import Store, count_awaiting_messages
+from .tenants import Tenant, TenantRegistry
+
+class TenantState:
+    """ What the scheduler knows about the messages of one tenant """
+    def __init__(self):
+        self.awaiting = 0
+        self.first_notified_at = None
+        self.last_notified_at = None
+        self.running = False
+
+class AnalysisScheduler:
+    """
+    Starts patching of memories when enough new messages are remembered.
+
+    The scheduler is notified by the memory of every open tenant every time messages are stored. When the number
+    of messages awaiting analysis of a tenant gets greater than `auto_patch_when_num_of_messages_is_greater_then`,
+    it waits until no new messages come for `scheduler_debounce` seconds, but not longer than `scheduler_max_latency`
+    seconds since the first of them, and then patches the memories of the tenant in its own thread.
+    Notifications that come while a patch is running are collected and checked when it is finished.
+    When there are no new messages the scheduler threads sleep and do not touch the database.
+
+    With `compaction_enabled` old analysed messages of the tenant are moved to the archive after every patch.
+
+    While the LLM circuit breaker is open no patches are started. Stopping the scheduler cancels running patches:
+    they make no new LLM requests and do not retry failed ones. It waits for them at most `scheduler_stop_timeout` seconds,
+    a request that is already running is not interrupted.
+
+    Only one process patches memories when several of them are started with the same databases, for example the
+    workers of the server. It is the process holding the `scheduler` lease in its own database file, next to the database
+    of the default tenant (`scheduler_lease_file_path`). Renewing the lease does not change the databases of tenants.
+    The lease is renewed every third of `scheduler_lease_ttl` seconds. Then the leader also loads the number of
+    messages awaiting analysis of all tenants, as it is not notified about messages stored by other processes.
+    Other processes try to take the lease at the same rate and start patching when the leader stops or dies.
+
+    Tenants are served in turns. One patch handles at most `patch_max_messages` messages, then the tenant
+    goes to the end of the queue, so a big backlog of one tenant does not delay the others.
+    """
+    def __init__(self, tenants: TenantRegistry, config: Config):
+        """
+        Args:
+            tenants (TenantRegistry): The tenants to patch. The scheduler subscribes to remember notifications of every opened tenant.
+            config (Config): Configuration object with the scheduler settings.
+        """
+        self.tenants = tenants
+        self.config = config
+
+        self.__condition = threading.Condition()
+        self.__states = OrderedDict() # tenant id -> TenantState, in the order of turns
+        self.__stopped = False
+        self.__cancel = threading.Event()
+        self.__threads = []
+        self.__breaker = get_llm_circuit_breaker(config)
+        self.__lease = None
+        self.__leader = False
+        self.__file_versions = {} # tenant id -> (modification times and sizes) of its database files when they were counted
+
+        self.tenants.add_open_listener(self.__watch)
+
+    def start(self) -> None:
+        """ Start the scheduler threads. Messages left unanalysed by previous runs are checked right away. """
+        with self.__condition:
+            self.__stopped = False
+            self.__cancel.clear()
+
+        self.__sync_all_awaiting()
+
+        self.__lease = Lease(Store(self.__lease_config()), "scheduler", new_owner_id(), self.config.scheduler_lease_ttl)
+        thread = threading.Thread(target=self.__keep_lease, daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+
+        for _ in range(max(1, self.config.scheduler_workers)):
+            thread = threading.Thread(target=self.__run, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self) -> None:
+        """ Stop the scheduler threads. Running patches are cancelled, threads still waiting for the LLM after `scheduler_stop_timeout` seconds are left behind. """
+        with self.__condition:
+            self.__stopped = True
+            self.__cancel.set()
+            self.__condition.notify_all()
+        deadline = time.monotonic() + self.config.scheduler_stop_timeout
+        for thread in self.__threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+            if thread.is_alive():
+                print("A patch is still waiting for the LLM. The scheduler is stopped without waiting for it.")
+        self.__threads = []
+
+        if self.__lease is not None:
+            if self.__leader:
+                self.__lease.release()
+            self.__lease.store.close()
+            self.__lease = None
+            self.__leader = False
+
+    def notify(self, tenant_id: str, count: int = 1) -> None:
+        """ Tell the scheduler that `count` new messages were stored for the tenant. """
+        with self.__condition:
+            now = time.monotonic()
+            state = self.__state(tenant_id)
+            state.awaiting += count
+            self.__report_backlog(tenant_id, state)
+            state.last_notified_at = now
+            if state.first_notified_at is None:
+                state.first_notified_at = now
+            self.__condition.notify_all()
+
+    def __watch(self, tenant: Tenant) -> None:
+        """ Subscribe to the messages of an opened tenant and load the number of messages it has awaiting analysis """
+        tenant.memory.add_remember_listener(lambda count: self.notify(tenant.id, count))
+        with self.__condition:
+            self.__sync_awaiting(tenant.id, tenant)
+            self.__condition.notify_all()
+
+    def __lease_config(self) -> Config:
+        """ Copy of the config with the database file of the scheduler lease. With the lease in the database of the default
+        tenant, every renewal would change the file and the leader would count its messages again on every renewal """
+        config = copy.copy(self.config)
+        config.database_file_path = self.config.scheduler_lease_file_path or self.config.database_file_path + "-scheduler"
+        return config
+
+    def __keep_lease(self) -> None:
+        """ Take or renew the scheduler lease until the scheduler is stopped """
+        while True:
+            try:
+                leader = self.__lease.acquire()
+            except Exception as e:
+                print(f"Failed to renew the scheduler lease: {e}")
+                leader = False
+
+            with self.__condition:
+                if leader != self.__leader:
+                    print("This process patches memories now." if leader else "Another process patches memories now.")
+                    self.__leader = leader
+                    metrics.set("scheduler_leader", 1 if leader else 0)
+                    self.__condition.notify_all()
+
+            if leader:
+                try:
+                    self.__sync_all_awaiting()
+                except Exception as e:
+                    print(f"Failed to check messages awaiting analysis: {e}")
+
+            with self.__condition:
+                if self.__condition.wait_for(lambda: self.__stopped, timeout=self.config.scheduler_lease_ttl / 3):
+                    return
+
+    def __sync_all_awaiting(self) -> None:
+        """ Load the number of messages awaiting analysis of all tenants. Messages can be stored by other processes,
+        the leader does not get notifications about them.
+        The numbers are read from the database files directly, tenants are only opened when they are patched.
+        Files that did not change since they were counted last time are skipped """
+        for tenant_id in self.tenants.list_tenant_ids():
+            path = self.tenants.database_file_path(tenant_id)
+            version = self.__file_version(path)
+            if version is None or self.__file_versions.get(tenant_id) == version:
+                continue
+            awaiting = count_awaiting_messages(path, self.config.database_busy_timeout)
+            self.__file_versions[tenant_id] = version
+
+            with self.__condition:
+                state = self.__state(tenant_id)
+                # tenants with notifications of this process are checked when they are due
+                if not state.running and state.last_notified_at is None:
+                    state.awaiting = awaiting
+                    self.__report_backlog(tenant_id, state)
+                    state.first_notified_at = None
+                    self.__condition.notify_all()
+
+    def __file_version(self, path: str) -> tuple:
+        """ Modification times and sizes of the database file and its WAL file. None if the database does not exist """
+        version = []
+        for file_path in (path, path + "-wal"):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                if file_path == path:
+                    return None
+                version.append(None)
+                continue
+            version.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(version)
+
+    def __run(self) -> None:
+        """ Wait for a tenant with enough messages, patch its memories, repeat until stopped. """
+        while True:
+            tenant_id = self.__wait_for_patch()
+            if tenant_id is None:
+                return
+
+            tenant = self.tenants.get(tenant_id)
+            try:
+                result = tenant.memory.patch_memories(self.config.patch_max_messages, self.__cancel)
+                print(result)
+                if self.config.compaction_enabled and not self.__cancel.is_set():
+                    print(tenant.memory.compact())
+            except CircuitOpenError as e:
+                # patches wait for the breaker in __wait_for_patch
+                print(f"Failed to patch memories: {e}")
+            except Exception as e:
+                print(f"Failed to patch memories: {e}")
+                with self.__condition:
+                    self.__condition.wait_for(lambda: self.__stopped, timeout=self.config.scheduler_retry_delay)
+
+            with self.__condition:
+                # messages could come while patching. Start again from the real number
+                self.__sync_awaiting(tenant_id, tenant)
+                self.__states[tenant_id].running = False
+                self.__states.move_to_end(tenant_id)
+                self.__condition.notify_all()
+
+    def __wait_for_patch(self) -> str:
+        """ Block until a tenant has to be patched and mark it running. Returns None when the scheduler is stopped. """
+        with self.__condition:
+            while not self.__stopped:
+                if not self.__leader:
+                    self.__condition.wait()
+                    continue
+
+                now = time.monotonic()
+                wake_at = None
+
+                retry_at = self.__breaker.retry_at()
+                if retry_at is not None and retry_at > now:
+                    # the LLM is unavailable. Messages keep collecting until it can be tried again
+                    self.__condition.wait(retry_at - now)
+                    continue
+
+                for tenant_id, state in self.__states.items():
+                    if state.running or state.awaiting <= self.config.auto_patch_when_num_of_messages_is_greater_then:
+                        continue
+
+                    start_at = now
+                    if state.last_notified_at is not None:
+                        start_at = min(
+                            state.last_notified_at + self.config.scheduler_debounce,
+                            state.first_notified_at + self.config.scheduler_max_latency,
+                        )
+                    if start_at <= now:
+                        state.running = True
+                        state.first_notified_at = None
+                        state.last_notified_at = None
+                        return tenant_id
+
+                    if wake_at is None or start_at < wake_at:
+                        wake_at = start_at
+
+                self.__condition.wait(None if wake_at is None else wake_at - now)
+        return None
+
+    def __sync_awaiting(self, tenant_id: str, tenant: Tenant) -> None:
+        """ Load the number of messages awaiting analysis. Must be called with the condition locked """
+        state = self.__state(tenant_id)
+        state.awaiting = tenant.memory.get_number_of_messages_awaiting_for_analysis()
+        self.__report_backlog(tenant_id, state)
+        state.first_notified_at = None
+        state.last_notified_at = None
+
+    def __state(self, tenant_id: str) -> TenantState:
+        """ The state of the tenant. Must be called with the condition locked """
+        state = self.__states.get(tenant_id)
+        if state is None:
+            state = TenantState()
+            self.__states[tenant_id] = state
+        return state
+
+    def __report_backlog(self, tenant_id: str, state: TenantState) -> None:
+        """ Report the number of messages awaiting analysis of the tenant in metrics """
+        metrics.set("analysis_backlog_messages", state.awaiting, tenant=tenant_id or "default")
@@ -0,0 +1,338 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from .config import Config
+from .metrics import metrics
+from .topics import merge_topics
+
+def fts_text(value: str) -> str:
+    """ SQL expression of the text of a message for the full-text index. Messages are stored as JSON,
+    only its strings are indexed, with the escapes decoded. The value is a column or a named parameter
+    """
+    return f"CASE WHEN json_valid({value}) THEN (SELECT group_concat(value, ' ') FROM json_tree({value}) WHERE type = 'text') ELSE {value} END"
+
+# Indexes every new message. Bulk imports can drop it and index the imported messages at once
+FTS_INSERT_TRIGGER = f"""
+    CREATE TRIGGER IF NOT EXISTS memory_fts_insert AFTER INSERT ON memory BEGIN
+        INSERT INTO memory_fts (rowid, data) VALUES (new.id, {fts_text("new.data")});
+    END
+"""
+
+# Held by an import that defers the search index while it runs. If it expires, the import was killed and the index is finished by others
+FTS_IMPORT_LEASE = "fts_deferred_import"
+
+class Store:
+    """
+    Store keeps a bounded pool of SQLite connections to the memory database.
+
+    The schema is created once, when the store is opened. Connections are configured with WAL journal mode
+    and tuned pragmas, and are handed out to one thread at a time with the `connection()` context manager.
+    """
+    def __init__(self, config: Config):
+        """
+        Open the database and create the schema.
+
+        Args:
+            config (Config): Configuration object containing database file path and pool settings.
+        """
+        self.config = config
+        self.path = config.database_file_path
+        self.__pool = queue.LifoQueue(maxsize=config.database_pool_size)
+        self.__lock = threading.Lock()
+        self.__opened = 0
+        self.__closed = False
+
+        with self.connection() as conn:
+            self._create_tables(conn)
+
+    @contextmanager
+    def connection(self, statement: str = "other"):
+        """
+        Borrow a connection from the pool. It is returned to the pool when the context exits.
+        Use `with conn:` inside to run statements in a transaction.
+
+        Args:
+            statement (str): Class of the statements run with the connection. The time the connection is held
+                is reported in the `db_statement_duration_seconds` metric with this label.
+        """
+        with metrics.timed("db_statement_duration_seconds", statement=statement):
+            conn = self.__acquire()
+            try:
+                yield conn
+            finally:
+                self.__release(conn)
+
+    def close(self) -> None:
+        """ Close all idle connections. Connections still borrowed are closed when they are returned. """
+        with self.__lock:
+            self.__closed = True
+        while True:
+            try:
+                self.__pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __acquire(self) -> sqlite3.Connection:
+        """ Take an idle connection, open a new one if the pool is not full yet, or wait for one to be returned. """
+        try:
+            return self.__pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.__lock:
+            # A closed store still serves the callers that hold it. Their connections are closed when returned
+            if self.__closed or self.__opened < self.config.database_pool_size:
+                self.__opened += 1
+                return self.__connect()
+
+        start = time.perf_counter()
+        try:
+            return self.__pool.get(timeout=self.config.database_pool_timeout)
+        except queue.Empty:
+            metrics.inc("db_pool_timeouts_total")
+            raise TimeoutError(f"No free database connection for {self.path} after {self.config.database_pool_timeout} seconds")
+        finally:
+            metrics.observe("db_pool_wait_seconds", time.perf_counter() - start)
+
+    def __release(self, conn: sqlite3.Connection) -> None:
+        """ Return the connection to the pool, rolling back anything left uncommitted. """
+        if conn.in_transaction:
+            conn.rollback()
+        with self.__lock:
+            if not self.__closed:
+                self.__pool.put_nowait(conn)
+                return
+            self.__opened -= 1
+        conn.close()
+
+    def __connect(self) -> sqlite3.Connection:
+        """ Open a new connection and apply the pragmas. """
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.config.database_busy_timeout,
+            check_same_thread=False,
+        )
+        # Free pages can be released in small steps, without a blocking VACUUM.
+        # It only takes effect for a new database, so it has to come before anything is written
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA cache_size = -{int(self.config.database_cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.config.database_mmap_size)}")
+        return conn
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        """Create tables if they do not exist."""
+        fts_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'memory_fts'").fetchone() is not None
+
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS memory (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    role TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    analysed INTEGER DEFAULT 0
+                )
+            """)
+            # Messages are claimed by the analyser that works on them, so parallel analysers get different messages
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(memory)").fetchall()]
+            if "claimed_by" not in columns:
+                conn.execute("ALTER TABLE memory ADD COLUMN claimed_by TEXT")
+                conn.execute("ALTER TABLE memory ADD COLUMN claim_expires REAL")
+            # Time the message was stored, in seconds since the epoch. Messages stored before the column existed have none
+            if "created_at" not in columns:
+                conn.execute("ALTER TABLE memory ADD COLUMN created_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS memory_analysed_id ON memory (analysed, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS memory_role_created_at ON memory (role, created_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT NOT NULL PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_profile (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    data TEXT NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS key_topics (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    topic TEXT NOT NULL,
+                    count INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS summary (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    reference TEXT NOT NULL,
+                    summary TEXT NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS memory_embeddings (
+                    id INTEGER PRIMARY KEY,
+                    vector BLOB NOT NULL
+                )
+            """)
+            # Precomputed parts of the memories for the query-scoped recall: profile keys, key topics and summary segments
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS memory_fragments USING fts5(
+                    kind UNINDEXED,
+                    position UNINDEXED,
+                    text,
+                    tokenize = 'porter unicode61'
+                )
+            """)
+            # Analysed messages moved out of the memory table by compaction. Every row is a segment of messages
+            # with ids from first_id to last_id, stored as a compressed JSON list of [id, role, data, created_at].
+            # Segments archived before messages had the time have no created_at. Segments do not overlap
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS memory_archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    first_id INTEGER NOT NULL,
+                    last_id INTEGER NOT NULL,
+                    rows INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )
+            """)
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS memory_archive_last_id ON memory_archive (last_id)")
+            # Full-text index over the text of memory.data. It is kept in sync by triggers
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(
+                    data,
+                    content='memory',
+                    content_rowid='id'
+                )
+            """)
+            # Before, the index had the JSON of messages, with escaped letters and keys. Such index is built again
+            update_trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'memory_fts_update'").fetchone()
+            reindex = not fts_exists or (update_trigger is not None and "json_tree" not in update_trigger[0])
+            if reindex:
+                for trigger in ("memory_fts_insert", "memory_fts_delete", "memory_fts_update"):
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            if conn.execute("SELECT 1 FROM metadata WHERE key = 'fts_deferred_after'").fetchone() is None:
+                conn.execute(FTS_INSERT_TRIGGER)
+            elif self.finish_fts_index(conn, abandoned_only=True):
+                print("Search index of an interrupted import with deferred index is finished.")
+            else:
+                print("Search index is not updated until the import with deferred index is finished.")
+            # Messages moved to the archive stay in the index, so they can still be found
+            delete_trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'memory_fts_delete'").fetchone()
+            if delete_trigger is not None and "memory_archive" not in delete_trigger[0]:
+                conn.execute("DROP TRIGGER memory_fts_delete")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS memory_fts_delete AFTER DELETE ON memory
+                WHEN COALESCE((SELECT first_id FROM memory_archive WHERE last_id >= old.id ORDER BY last_id LIMIT 1), old.id + 1) > old.id
+                BEGIN
+                    INSERT INTO memory_fts (memory_fts, rowid, data) VALUES ('delete', old.id, {fts_text("old.data")});
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS memory_fts_update AFTER UPDATE OF data ON memory BEGIN
+                    INSERT INTO memory_fts (memory_fts, rowid, data) VALUES ('delete', old.id, {fts_text("old.data")});
+                    INSERT INTO memory_fts (rowid, data) VALUES (new.id, {fts_text("new.data")});
+                END
+            """)
+            for table in ("key_topics", "rebuild_key_topics"):
+                self._migrate_key_topics(conn, table)
+            if reindex:
+                # The database was created before the index existed or with the old index. Index the messages stored so far
+                self._index_messages(conn)
+
+    def finish_fts_index(self, conn: sqlite3.Connection, abandoned_only: bool = False) -> bool:
+        """ Index the messages stored since an import deferred the search index and index new messages one by one again.
+
+        Args:
+            conn (sqlite3.Connection): Connection to use, in a transaction.
+            abandoned_only (bool): Finish the index only if no import holds the FTS_IMPORT_LEASE lease, so the import was killed.
+        Returns:
+            bool: True if the index was finished. False if it is not deferred or the import is still running.
+        """
+        deferred_after = conn.execute("SELECT value FROM metadata WHERE key = 'fts_deferred_after'").fetchone()
+        if deferred_after is None:
+            return False
+        if abandoned_only and conn.execute(
+            "SELECT 1 FROM leases WHERE name = ? AND expires_at >= ?", (FTS_IMPORT_LEASE, time.time())
+        ).fetchone() is not None:
+            return False
+
+        conn.execute(f"INSERT INTO memory_fts (rowid, data) SELECT id, {fts_text('data')} FROM memory WHERE id > ?", (int(deferred_after[0]),))
+        conn.execute(FTS_INSERT_TRIGGER)
+        conn.execute("DELETE FROM metadata WHERE key = 'fts_deferred_after'")
+        return True
+
+    def _index_messages(self, conn: sqlite3.Connection):
+        """ Build the full-text index of the stored and the archived messages from scratch.
+        The 'rebuild' command of FTS5 can not be used, it indexes memory.data as it is, and archived messages are not in the memory table
+        """
+        conn.execute("INSERT INTO memory_fts (memory_fts) VALUES ('delete-all')")
+        # messages of an import with deferred index are indexed when the import is finished
+        deferred_after = conn.execute("SELECT value FROM metadata WHERE key = 'fts_deferred_after'").fetchone()
+        if deferred_after is None:
+            conn.execute(f"INSERT INTO memory_fts (rowid, data) SELECT id, {fts_text('data')} FROM memory")
+        else:
+            conn.execute(f"INSERT INTO memory_fts (rowid, data) SELECT id, {fts_text('data')} FROM memory WHERE id <= ?", (int(deferred_after[0]),))
+        for (segment,) in conn.execute("SELECT data FROM memory_archive"):
+            conn.executemany(
+                f"INSERT INTO memory_fts (rowid, data) VALUES (:id, {fts_text(':data')})",
+                [{"id": row[0], "data": row[2]} for row in json.loads(zlib.decompress(segment))]
+            )
+
+    def _migrate_key_topics(self, conn: sqlite3.Connection, table: str):
+        """ Merge duplicate and differently spelled topics of databases created before topics were unique, then add the indexes """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+            return
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (f"{table}_topic",)).fetchone() is None:
+            topics = {}
+            for topic, count in conn.execute(f"SELECT topic, count FROM {table} ORDER BY id").fetchall():
+                merge_topics(topics, {topic: count})
+            conn.execute(f"DELETE FROM {table}")
+            conn.executemany(f"INSERT INTO {table} (topic, count) VALUES (?, ?)", topics.items())
+            conn.execute(f"CREATE UNIQUE INDEX {table}_topic ON {table} (topic)")
+        # for the most mentioned topics
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_count ON {table} (count)")
+
+def count_awaiting_messages(path: str, busy_timeout: float) -> int:
+    """ Number of messages awaiting analysis in the database file, read with a short-lived read-only connection
+    without opening a Store. Returns 0 if the database does not exist or has no messages yet """
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=busy_timeout)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM memory WHERE analysed = 0").fetchone()[0]
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e):
+            return 0
+        raise
+    finally:
+        conn.close()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(config: Config) -> Store:
+    """
+    Returns the process-wide store for the database file from the config. The store is opened on first use.
+    """
+    with _stores_lock:
+        store = _stores.get(config.database_file_path)
+        if store is None:
+            store = Store(config)
+            _stores[config.database_file_path] = store
+        return store
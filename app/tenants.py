@@ -0,0 +1,125 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from .config import Config
+from .memory import Memory
+from .store import Store
+from .write_buffer import WriteBuffer
+
+DEFAULT_TENANT = ""
+
+class Tenant:
+    """
+    The memory of one tenant and its optional write buffer.
+    """
+    def __init__(self, tenant_id: str, config: Config):
+        """
+        Args:
+            tenant_id (str): Tenant id. The default tenant uses `database_file_path`.
+            config (Config): Configuration object for this tenant.
+        """
+        self.id = tenant_id
+        self.memory = Memory(config, Store(config))
+        self.write_buffer = None
+        if config.remember_buffer_enabled:
+            self.write_buffer = WriteBuffer(self.memory, config.remember_buffer_max_size, config.remember_buffer_max_delay)
+            self.write_buffer.start()
+
+    def close(self) -> None:
+        """ Write buffered messages and close the database connections. """
+        if self.write_buffer:
+            self.write_buffer.close()
+        self.memory.store.close()
+
+class TenantRegistry:
+    """
+    Keeps the open tenants.
+
+    Every tenant has its own SQLite file in `tenants_directory`, named by a hash of its auth token.
+    Requests without a token, or all requests when `tenants_enabled` is off, use the default tenant with `database_file_path`.
+    At most `tenant_cache_size` tenants are kept open. The least recently used tenant is closed when one more is opened.
+    """
+    def __init__(self, config: Config):
+        self.config = config
+
+        self.__tenants = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__open_listeners = []
+
+    def tenant_id(self, auth_token: str) -> str:
+        """ Returns the tenant id for the auth token. """
+        if not self.config.tenants_enabled or not auth_token:
+            return DEFAULT_TENANT
+        return hashlib.sha256(auth_token.encode()).hexdigest()[:32]
+
+    def get(self, tenant_id: str) -> Tenant:
+        """ Returns the tenant. It is opened if it is not open yet. """
+        opened = None
+        evicted = []
+
+        with self.__lock:
+            tenant = self.__tenants.get(tenant_id)
+            if tenant is not None:
+                self.__tenants.move_to_end(tenant_id)
+                return tenant
+
+            tenant = Tenant(tenant_id, self.__tenant_config(tenant_id))
+            self.__tenants[tenant_id] = tenant
+            opened = tenant
+
+            while len(self.__tenants) > max(1, self.config.tenant_cache_size):
+                _, old = self.__tenants.popitem(last=False)
+                evicted.append(old)
+
+        for old in evicted:
+            old.close()
+
+        for listener in self.__open_listeners:
+            listener(opened)
+
+        return tenant
+
+    def list_tenant_ids(self) -> list:
+        """ Returns ids of all tenants that have a database. """
+        tenant_ids = [DEFAULT_TENANT]
+        if self.config.tenants_enabled and os.path.isdir(self.config.tenants_directory):
+            for file_name in sorted(os.listdir(self.config.tenants_directory)):
+                if file_name.endswith(".db"):
+                    tenant_ids.append(file_name[:-3])
+        return tenant_ids
+
+    def add_open_listener(self, listener) -> None:
+        """
+        Register a function to call when a tenant is opened.
+        Args:
+            listener (callable): Called with the Tenant.
+        """
+        self.__open_listeners.append(listener)
+
+    def close(self) -> None:
+        """ Close all open tenants. """
+        with self.__lock:
+            tenants = list(self.__tenants.values())
+            self.__tenants.clear()
+        for tenant in tenants:
+            tenant.close()
+
+    def database_file_path(self, tenant_id: str) -> str:
+        """ Path of the database file of the tenant. The file does not exist before the tenant is opened the first time """
+        if tenant_id == DEFAULT_TENANT:
+            return self.config.database_file_path
+        return os.path.join(self.config.tenants_directory, f"{tenant_id}.db")
+
+    def __tenant_config(self, tenant_id: str) -> Config:
+        """ Copy of the config with the database file of the tenant """
+        if tenant_id == DEFAULT_TENANT:
+            return self.config
+
+        os.makedirs(self.config.tenants_directory, exist_ok=True)
+
+        config = copy.copy(self.config)
+        config.database_file_path = self.database_file_path(tenant_id)
+        return config
@@ -0,0 +1,76 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import Config
+from .metrics import metrics
+
+class ToolRunner:
+    """
+    Runs the blocking work of MCP tools out of the event loop.
+
+    The work runs in a bounded pool of `tool_executor_workers` threads. Every tool can have at most
+    `tool_concurrency_limit` calls in the pool at a time, other calls of the tool wait for their turn without
+    taking threads from other tools. A call that does not finish in `tool_timeout` seconds fails. Its thread
+    can not be interrupted, so the call keeps its place in the limit until the work is really finished.
+    """
+    def __init__(self, config: Config):
+        """
+        Args:
+            config (Config): Configuration object with the tool executor settings.
+        """
+        self.config = config
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max(1, config.tool_executor_workers),
+            thread_name_prefix="mcp-tool",
+        )
+        self.__semaphores = {} # tool name -> asyncio.Semaphore
+
+    def offload(self, fn):
+        """
+        Decorator that turns a blocking tool function into a coroutine function that runs it in the pool.
+        The signature of the function is kept, so the tool schema does not change.
+        """
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.run(fn.__name__, fn, *args, **kwargs)
+        return wrapper
+
+    async def run(self, tool: str, fn, *args, **kwargs):
+        """ Run the function in the pool within the limits of the tool. Context variables of the caller are visible to the function.
+        The timeout includes the time the call waits for its turn.
+        """
+        try:
+            return await asyncio.wait_for(self.__run(tool, fn, *args, **kwargs), self.config.tool_timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("mcp_tool_timeouts_total", tool=tool)
+            raise TimeoutError(f"Tool {tool} did not finish in {self.config.tool_timeout} seconds")
+
+    async def __run(self, tool: str, fn, *args, **kwargs):
+        semaphore = self.__semaphores.get(tool)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(max(1, self.config.tool_concurrency_limit))
+            self.__semaphores[tool] = semaphore
+
+        await semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        try:
+            future = self.__executor.submit(context.run, functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            semaphore.release()
+            raise
+        # the place is released when the work is finished or cancelled before it started, not when the caller gives up
+        future.add_done_callback(lambda _: self.__release(loop, semaphore))
+
+        return await asyncio.wrap_future(future)
+
+    def __release(self, loop: asyncio.AbstractEventLoop, semaphore: asyncio.Semaphore) -> None:
+        """ Release the place of a call in the loop of the semaphore. Called from the pool threads """
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(semaphore.release)
+
+    def close(self) -> None:
+        """ Stop the pool threads. Queued calls are cancelled """
+        self.__executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,28 @@
+def normalize_topic(topic) -> str:
+    """ The form a topic is stored in: lower case, single spaces, no punctuation around. Returns "" for an unusable topic """
+    if not isinstance(topic, str):
+        return ""
+    return " ".join(topic.split()).strip(" .,;:!?\"'`").lower()
+
+def merge_topics(topics: dict, new_topics: dict) -> dict:
+    """
+    Add counts of new topics to the topics. Topics are normalized, so different spellings of one topic are counted together.
+    Counts that are not positive numbers are counted as one mention.
+
+    Returns:
+        dict: The topics dict, changed in place.
+    """
+    if not isinstance(new_topics, dict):
+        return topics
+    for topic, count in new_topics.items():
+        topic = normalize_topic(topic)
+        if topic == "":
+            continue
+        if isinstance(count, bool) or not isinstance(count, (int, float)) or count < 1:
+            count = 1
+        topics[topic] = topics.get(topic, 0) + int(count)
+    return topics
+
+def top_topics(topics: dict, limit: int) -> dict:
+    """ The most mentioned topics, most mentioned first """
+    return dict(sorted(topics.items(), key=lambda item: (-item[1], item[0]))[:max(0, limit)])
@@ -0,0 +1,77 @@
+import threading
+
+from .memory import Memory
+
+class WriteBuffer:
+    """
+    Write-behind buffer for remembered messages.
+
+    Messages are collected in memory and written with one transaction when the buffer reaches
+    the maximum size or when the oldest message has waited the maximum delay.
+    Messages are written in the order they were added.
+    """
+    def __init__(self, memory: Memory, max_size: int, max_delay: float):
+        """
+        Args:
+            memory (Memory): The memory to write the messages to.
+            max_size (int): Number of messages that triggers a write.
+            max_delay (float): Seconds a message can wait in the buffer.
+        """
+        self.memory = memory
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self.__messages = []
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.__closed = False
+
+    def start(self) -> None:
+        """ Start the background thread that writes the buffer on time. """
+        self.__closed = False
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def close(self) -> None:
+        """ Stop the background thread and write everything left in the buffer.
+        Messages added after this are written right away. """
+        self.__closed = True
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def add(self, role: str, contents: list | dict | str) -> None:
+        """ Add a message to the buffer. Writes the buffer if it is full. """
+        with self.__lock:
+            self.__messages.append((role, contents))
+            full = len(self.__messages) >= self.max_size
+
+        if full or self.__closed:
+            self.flush()
+
+    def flush(self) -> int:
+        """ Write all buffered messages to the memory. Returns the number of written messages. """
+        with self.__flush_lock:
+            with self.__lock:
+                messages, self.__messages = self.__messages, []
+
+            try:
+                return self.memory.remember_batch(messages)
+            except Exception:
+                # Keep the messages so the next flush can retry them
+                with self.__lock:
+                    self.__messages = messages + self.__messages
+                raise
+
+    def __run(self) -> None:
+        """ Write the buffer every `max_delay` seconds until stopped. """
+        while not self.__stop_event.wait(self.max_delay):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to write buffered messages: {e}")
@@ -0,0 +1,52 @@
+import json
+import threading
+import time
+
+import app.analyser
+
+class FakeOllama:
+    """
+    Stand-in for `ollama.chat` used by the analyser. It answers every request after a fixed latency,
+    with a response of the shape the analyser expects for the request.
+    """
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency (float): Seconds to wait before every response.
+        """
+        self.latency = latency
+        self.calls = 0
+        self.prompt_symbols = 0
+
+        self.__lock = threading.Lock()
+        self.__original_chat = None
+
+    def install(self) -> None:
+        """ Replace the chat function of the analyser with the fake one. """
+        self.__original_chat = app.analyser.chat
+        app.analyser.chat = self.chat
+
+    def uninstall(self) -> None:
+        """ Restore the original chat function. """
+        if self.__original_chat is not None:
+            app.analyser.chat = self.__original_chat
+            self.__original_chat = None
+
+    def chat(self, model: str, messages: list, **kwargs) -> dict:
+        """ Same signature as `ollama.chat`. """
+        with self.__lock:
+            self.calls += 1
+            self.prompt_symbols += sum(len(message['content']) for message in messages)
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        system_hint = messages[0]['content']
+        if "user information" in system_hint:
+            content = json.dumps({"name": "Benchmark User", "interests": ["benchmarks"]})
+        elif "key topics" in system_hint:
+            content = json.dumps({"benchmarks": 1, "performance": 1})
+        else:
+            content = f"Summary of {len(messages[-1]['content'])} symbols of conversation."
+
+        return {'message': {'role': 'assistant', 'content': content}}
@@ -0,0 +1,262 @@
+import typer
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+application_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(application_path)
+
+from app.config import Config
+from app.memory import Memory
+from benchmarks.fake_ollama import FakeOllama
+
+"""
+Benchmarks of the memory server. They run offline, the LLM is replaced with a fake one with configurable latency.
+Results are printed and can be saved as JSON to compare runs.
+
+python benchmarks/run.py --output results.json
+"""
+
+app = typer.Typer()
+
+WORDS = [f"{a}{b}" for a in ("ka", "lo", "mi", "nu", "pe", "ra", "si", "to", "vu", "ze") for b in ("bar", "cen", "dor", "fin", "gal", "hum", "jet", "kos", "lim", "mar")]
+
+def make_message(rnd: random.Random, words: int = 20) -> str:
+    """ A random message from the fixed vocabulary """
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+def latency_stats(samples: list) -> dict:
+    """ Percentiles of latency samples, in milliseconds """
+    samples = sorted(samples)
+    if len(samples) == 0:
+        return {}
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+def make_config(directory: str) -> Config:
+    """ Config with a fresh database in the directory. The LLM cache is disabled to measure real work """
+    config = Config()
+    config.database_file_path = os.path.join(directory, "memories.db")
+    config.llm_cache_file_path = ""
+    return config
+
+def bench_remember(directory: str, messages: int) -> dict:
+    """ Throughput of single and batched remember """
+    memory = Memory(make_config(directory))
+    rnd = random.Random(1)
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        memory.remember("user", make_message(rnd))
+    single = time.perf_counter() - start
+
+    batch = [("user", make_message(rnd)) for _ in range(messages)]
+    start = time.perf_counter()
+    memory.remember_batch(batch)
+    batched = time.perf_counter() - start
+
+    memory.store.close()
+    return {
+        "messages": messages,
+        "single_messages_per_second": round(messages / single, 1),
+        "batch_messages_per_second": round(messages / batched, 1),
+    }
+
+def bench_reads(directory: str, sizes: list, queries: int) -> list:
+    """ Latency of recall and search while the database grows """
+    memory = Memory(make_config(directory))
+    rnd = random.Random(2)
+    results = []
+    rows = 0
+
+    # Give recall something to return
+    fake = FakeOllama()
+    fake.install()
+    memory.remember_batch([("user", make_message(rnd)) for _ in range(10)])
+    memory.patch_memories()
+    fake.uninstall()
+    rows = 10
+
+    for size in sizes:
+        while rows < size:
+            count = min(10000, size - rows)
+            memory.remember_batch([("user" if i % 2 == 0 else "assistant", make_message(rnd)) for i in range(count)])
+            rows += count
+
+        recall = []
+        for _ in range(queries):
+            start = time.perf_counter()
+            memory.recall()
+            recall.append(time.perf_counter() - start)
+
+        search = []
+        for _ in range(queries):
+            query = " ".join(rnd.sample(WORDS, 2))
+            start = time.perf_counter()
+            memory.search(query)
+            search.append(time.perf_counter() - start)
+
+        history = []
+        for _ in range(queries):
+            start_id = rnd.randint(1, rows)
+            start = time.perf_counter()
+            memory.history_page(start_id, None, 100)
+            history.append(time.perf_counter() - start)
+
+        results.append({
+            "rows": rows,
+            "recall": latency_stats(recall),
+            "search": latency_stats(search),
+            "history_page": latency_stats(history),
+        })
+        print(f"  {rows} rows done")
+
+    memory.store.close()
+    return results
+
+def bench_patch(directory: str, messages: int, latency: float) -> dict:
+    """ Speed of patch_memories with the fake LLM """
+    config = make_config(directory)
+    memory = Memory(config)
+    rnd = random.Random(3)
+    memory.remember_batch([("user" if i % 2 == 0 else "assistant", make_message(rnd, 50)) for i in range(messages)])
+
+    fake = FakeOllama(latency)
+    fake.install()
+    try:
+        start = time.perf_counter()
+        memory.patch_memories()
+        elapsed = time.perf_counter() - start
+    finally:
+        fake.uninstall()
+
+    memory.store.close()
+    return {
+        "messages": messages,
+        "llm_latency_seconds": latency,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(messages / elapsed, 1),
+        "llm_calls": fake.calls,
+        "llm_prompt_symbols": fake.prompt_symbols,
+    }
+
+def bench_mcp(directory: str, clients: int, calls: int, latency: float, port: int) -> dict:
+    """ End-to-end latency of MCP tools through the server app with concurrent clients """
+    import uvicorn
+    from mcp import ClientSession
+    from mcp.client.sse import sse_client
+
+    os.environ["DATABASE_FILE_PATH"] = os.path.join(directory, "memories.db")
+    os.environ["LLM_CACHE_FILE_PATH"] = ""
+    import mcp_server
+
+    fake = FakeOllama(latency)
+    fake.install()
+
+    server = uvicorn.Server(uvicorn.Config(mcp_server.app, host="127.0.0.1", port=port, log_level="critical", timeout_graceful_shutdown=1))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    samples = {"remember": [], "recall": [], "search_in_memory": []}
+
+    async def client(number: int):
+        rnd = random.Random(100 + number)
+        async with sse_client(f"http://127.0.0.1:{port}/sse") as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                for _ in range(calls):
+                    for tool, args in (
+                        ("remember", {"role": "user", "contents": make_message(rnd)}),
+                        ("recall", {}),
+                        ("search_in_memory", {"data": rnd.choice(WORDS)}),
+                    ):
+                        start = time.perf_counter()
+                        await session.call_tool(tool, args)
+                        samples[tool].append(time.perf_counter() - start)
+
+    async def run_clients():
+        await asyncio.gather(*(client(i) for i in range(clients)))
+
+    start = time.perf_counter()
+    try:
+        asyncio.run(run_clients())
+    finally:
+        elapsed = time.perf_counter() - start
+        server.should_exit = True
+        thread.join()
+        fake.uninstall()
+
+    total = sum(len(values) for values in samples.values())
+    return {
+        "clients": clients,
+        "calls_per_client": calls,
+        "calls_per_second": round(total / elapsed, 1),
+        "tools": {tool: latency_stats(values) for tool, values in samples.items()},
+    }
+
+@app.command()
+def run(
+    sizes: str = typer.Option("1000,10000,100000", help="Database sizes for read latency, comma separated. Add 1000000 for the full run"),
+    remember_messages: int = typer.Option(2000, help="Messages for the remember throughput"),
+    patch_messages: int = typer.Option(500, help="Messages for the patch speed"),
+    llm_latency: float = typer.Option(0.05, help="Latency of the fake LLM in seconds"),
+    queries: int = typer.Option(50, help="Queries per read measurement"),
+    mcp_clients: int = typer.Option(8, help="Concurrent MCP clients. 0 to skip the MCP benchmark"),
+    mcp_calls: int = typer.Option(20, help="Rounds of tool calls per MCP client"),
+    port: int = typer.Option(8765, help="Port for the MCP server"),
+    output: Optional[str] = typer.Option(None, help="File to write the JSON results to"),
+):
+    """Runs the benchmarks"""
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("remember throughput...")
+        os.makedirs(os.path.join(directory, "remember"))
+        results["remember"] = bench_remember(os.path.join(directory, "remember"), remember_messages)
+
+        print("read latency...")
+        os.makedirs(os.path.join(directory, "reads"))
+        results["reads"] = bench_reads(os.path.join(directory, "reads"), [int(size) for size in sizes.split(",")], queries)
+
+        print("patch speed...")
+        os.makedirs(os.path.join(directory, "patch"))
+        results["patch"] = bench_patch(os.path.join(directory, "patch"), patch_messages, llm_latency)
+
+        if mcp_clients > 0:
+            print("MCP tools...")
+            os.makedirs(os.path.join(directory, "mcp"))
+            results["mcp"] = bench_mcp(os.path.join(directory, "mcp"), mcp_clients, mcp_calls, llm_latency, port)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,105 @@
+import typer
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+application_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+"""
+Cold start time of the CLI and the server. Every command runs in a new Python process, as it does from scripts and cron.
+The run fails when a command is slower than its limit or loads modules it does not need, so it can guard the start time in CI.
+
+python benchmarks/startup.py --output startup.json
+"""
+
+app = typer.Typer()
+
+# Modules that are only loaded when their feature is used
+CLI_DEFERRED_MODULES = ("ollama", "numpy", "fastapi", "mcp")
+SERVER_DEFERRED_MODULES = ("ollama", "numpy")
+
+def command_time(args: list, env: dict, runs: int) -> float:
+    """ Median wall time of the command in seconds """
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=application_path, env=env, capture_output=True, check=True)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+def loaded_modules(args: list, env: dict) -> set:
+    """ Top level packages imported by the command, from the -X importtime report """
+    result = subprocess.run([args[0], "-X", "importtime"] + args[1:], cwd=application_path, env=env, capture_output=True, text=True, check=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return modules
+
+@app.command()
+def run(
+    runs: int = typer.Option(5, help="Runs of every command. The median is reported"),
+    max_cli_seconds: float = typer.Option(1.0, help="Limit of the start time of CLI commands"),
+    max_server_seconds: float = typer.Option(3.0, help="Limit of the time to load the server application"),
+    output: Optional[str] = typer.Option(None, help="File to write the JSON results to"),
+):
+    """Measures the cold start time of manager.py commands and the server"""
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "commands": {},
+    }
+    failures = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ)
+        env["DATABASE_FILE_PATH"] = os.path.join(directory, "memories.db")
+        env["LLM_CACHE_FILE_PATH"] = ""
+
+        commands = {
+            "python": ([sys.executable, "-c", "pass"], None, ()),
+            "cli_recall": ([sys.executable, "manager.py", "recall"], max_cli_seconds, CLI_DEFERRED_MODULES),
+            "cli_history_dump": ([sys.executable, "manager.py", "history-dump", "--limit", "10"], max_cli_seconds, CLI_DEFERRED_MODULES),
+            "cli_search": ([sys.executable, "manager.py", "search-in-memory", "hello"], max_cli_seconds, CLI_DEFERRED_MODULES),
+            "cli_stats": ([sys.executable, "manager.py", "stats"], max_cli_seconds, CLI_DEFERRED_MODULES),
+            # loading the module builds the FastAPI application. Threads are started by uvicorn later
+            "server_import": ([sys.executable, "-c", "import mcp_server"], max_server_seconds, SERVER_DEFERRED_MODULES),
+        }
+
+        # the database is created by the first run, it is not a part of the cold start
+        subprocess.run([sys.executable, "manager.py", "remember", "user", "hello"], cwd=application_path, env=env, capture_output=True, check=True)
+
+        for name, (args, limit, deferred) in commands.items():
+            print(f"{name}...")
+            seconds = command_time(args, env, runs)
+            loaded = sorted(loaded_modules(args, env) & set(deferred))
+            results["commands"][name] = {"seconds": round(seconds, 3), "limit_seconds": limit, "deferred_modules_loaded": loaded}
+
+            if limit is not None and seconds > limit:
+                failures.append(f"{name} took {seconds:.3f} seconds, the limit is {limit}")
+            if len(loaded) > 0:
+                failures.append(f"{name} loaded {', '.join(loaded)}")
+
+    results["failures"] = failures
+
+    text = json.dumps(results, indent=2)
+    print(text)
+
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+
+    if len(failures) > 0:
+        raise typer.Exit(1)
+
+if __name__ == "__main__":
+    app()
@@ -1,12 +1,17 @@
 import typer
 import os 
+import json
 import sys
+import time
+from typing import Optional
 application_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(application_path)
 
 from app.config import Config
 from app.config import Config
 from app.memory import Memory
+from app.llm_cache import get_llm_cache
+from app.jsonl import read_jsonl, write_jsonl
 
 """
 This is a command line interface for the memory server.
@@ -29,10 +34,69 @@ def remember(role: str, contents: str):
     print("ok")
 
 @app.command()
-def recall():
+def remember_batch(file_path: str):
+    """Remembers many messages from a JSON file with a list of {"role": ..., "contents": ...} objects. Use - to read from stdin"""
+
+    if file_path == "-":
+        messages = json.load(sys.stdin)
+    else:
+        with open(file_path) as f:
+            messages = json.load(f)
+
+    count = Memory(config).remember_batch([(message["role"], message["contents"]) for message in messages])
+
+    print(f"ok: {count}")
+
+@app.command("import")
+def import_log(
+    file_path: str,
+    defer_index: bool = typer.Option(False, help="Build the search index after all messages are stored. Faster for big files"),
+):
+    """Imports messages from a JSON lines file with a {"role": ..., "contents": ..., "created_at": ...} object on every line, created_at is optional. Files ending with .gz are decompressed. Use - to read from stdin"""
+
+    started = time.monotonic()
+
+    def messages():
+        for number, record in enumerate(read_jsonl(file_path), 1):
+            if not isinstance(record, dict) or "role" not in record or "contents" not in record:
+                raise ValueError(f"Record {number} has no role or contents")
+            yield record["role"], record["contents"], record.get("created_at")
+
+    def progress(count):
+        print(f"Imported {count} messages ({count / max(time.monotonic() - started, 0.001):.0f}/s)", file=sys.stderr)
+
+    count = Memory(config).import_messages(messages(), defer_index, progress)
+
+    print(f"ok: {count}")
+
+@app.command("export")
+def export_log(
+    file_path: str,
+    start_id: Optional[int] = typer.Option(None, help="The first message id to export"),
+    end_id: Optional[int] = typer.Option(None, help="The last message id to export"),
+):
+    """Exports messages to a JSON lines file, one {"id": ..., "role": ..., "contents": ..., "created_at": ...} object per line. Files ending with .gz are compressed. Use - to write to stdout"""
+
+    started = time.monotonic()
+
+    def records():
+        for count, record in enumerate(Memory(config).export_messages(start_id, end_id), 1):
+            yield record
+            if count % config.import_batch_size == 0:
+                print(f"Exported {count} messages ({count / max(time.monotonic() - started, 0.001):.0f}/s)", file=sys.stderr)
+
+    count = write_jsonl(file_path, records())
+
+    print(f"ok: {count}", file=sys.stderr if file_path == "-" else sys.stdout)
+
+@app.command()
+def recall(
+    query: Optional[str] = typer.Option(None, help="Text to select the relevant memories for"),
+    budget: Optional[int] = typer.Option(None, help="Maximum size of the result in symbols"),
+):
     """Recall the memory"""
     
-    r = Memory(config).recall()
+    r = Memory(config).recall(query, budget)
 
     if not r:
         print("none")
@@ -41,20 +105,50 @@ def recall():
     print(r)
 
 @app.command()
-def history_dump():
+def history_dump(
+    start_id: Optional[int] = typer.Option(None, help="The first message id to dump"),
+    end_id: Optional[int] = typer.Option(None, help="The last message id to dump"),
+    limit: Optional[int] = typer.Option(None, help="Maximum number of messages"),
+    since: Optional[str] = typer.Option(None, help="Dump messages stored at this time or later, ISO 8601"),
+    until: Optional[str] = typer.Option(None, help="Dump messages stored at this time or earlier, ISO 8601"),
+    role: Optional[str] = typer.Option(None, help="Dump messages of this role"),
+):
     """Dumps the history of the memory"""
     
-    gen = Memory(config).history_dump()
+    gen = Memory(config).history_dump(start_id, end_id, limit, since, until, role)
 
     print("Hostory:")
     for i in gen:
         print(i)
 
 @app.command()
-def search_in_memory(data: str):
+def search_in_memory(
+    data: str,
+    limit: Optional[int] = typer.Option(None, help="Maximum number of matches"),
+    window: Optional[int] = typer.Option(None, help="Messages to show before and after each match"),
+    since: Optional[str] = typer.Option(None, help="Match messages stored at this time or later, ISO 8601"),
+    until: Optional[str] = typer.Option(None, help="Match messages stored at this time or earlier, ISO 8601"),
+    role: Optional[str] = typer.Option(None, help="Match messages of this role"),
+):
     """Searches for data in the memory"""
     
-    r = Memory(config).search(data)
+    r = Memory(config).search(data, limit, window, since, until, role)
+
+    if not r:
+        print("none")
+        return
+
+    print(r)
+
+@app.command()
+def semantic_search(
+    query: str,
+    limit: Optional[int] = typer.Option(None, help="Maximum number of matches"),
+    window: Optional[int] = typer.Option(None, help="Messages to show before and after each match"),
+):
+    """Searches for messages with a meaning close to the query"""
+    
+    r = Memory(config).semantic_search(query, limit, window)
 
     if not r:
         print("none")
@@ -70,6 +164,14 @@ def clear_memory():
 
     print("ok")
 
+@app.command()
+def compact():
+    """Moves old analysed messages to the compressed archive and releases free space"""
+
+    result_log = Memory(config).compact()
+
+    print(result_log)
+
 @app.command()
 def patch_memories():
     """Patches the memories"""
@@ -86,5 +188,28 @@ def rebuild_memories():
 
     print(result_log)
 
+@app.command()
+def stats(
+    url: Optional[str] = typer.Option(None, help="Address of a running server, like http://localhost:8000. Its /metrics are printed too"),
+):
+    """Prints statistics of the memory database and the LLM cache"""
+
+    print("Database:")
+    for key, value in Memory(config).stats().items():
+        print(f"  {key}: {value}")
+
+    cache = get_llm_cache(config)
+    if cache is not None:
+        print("LLM cache:")
+        for key, value in cache.stats().items():
+            print(f"  {key}: {value}")
+
+    if url:
+        import urllib.request
+
+        with urllib.request.urlopen(url.rstrip("/") + "/metrics") as response:
+            print("Server metrics:")
+            print(response.read().decode())
+
 if __name__ == "__main__":
     app()
\ No newline at end of file
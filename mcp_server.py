@@ -1,40 +1,42 @@
 import os 
-import threading
-import time
+from contextvars import ContextVar
 from contextlib import asynccontextmanager
 from mcp.server.fastmcp import FastMCP
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 
 from app.config import Config
-from app.memory import Memory
+from app.tenants import Tenant, TenantRegistry
+from app.scheduler import AnalysisScheduler
+from app.metrics import metrics
+from app.tool_runner import ToolRunner
 
 # Load config
 config = Config(os.path.dirname(os.path.realpath(__file__)) + "/.env")
 
-# This will be used in future. Currently not used yet.
-auth_token = ""
-worker_stop_event = threading.Event()
-worker_thread = None  # Will hold our th
+# Open tenants. Every tenant keeps its own pool of database connections
+tenants = TenantRegistry(config)
 
+# Patches the memories when enough new messages are remembered
+scheduler = AnalysisScheduler(tenants, config)
 
-def worker():
-    """Worker thread to check for new messages and analyse them"""
-    while not worker_stop_event.is_set():
-        # every 30 seconds go to check ifthere are new messages and analyse them 
-        Memory(config).patch_memories_if_new_data()
-        time.sleep(30)
+# Runs the blocking work of tools out of the event loop, so a slow call does not stall other sessions
+tool_runner = ToolRunner(config)
+
+# The auth token of the current request. It selects the tenant
+auth_token: ContextVar[str] = ContextVar("auth_token", default="")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global worker_thread
-
-    worker_thread = threading.Thread(target=worker, daemon=True)
-    worker_thread.start()
+    scheduler.start()
 
     yield 
 
-    worker_stop_event.set()
-    worker_thread.join()
+    scheduler.stop()
+
+    tool_runner.close()
+
+    tenants.close()
 
 app = FastAPI(lifespan=lifespan)
 mcp = FastMCP("Memory Server")
@@ -44,29 +46,55 @@ async def auth_middleware(request: Request, call_next):
     """Middleware to check for the auth token in the header"""
     auth_header = request.headers.get("Authorization")
     if auth_header:
-        # extract token from the header and keep it in the global variable
-        global auth_token
-        auth_token = auth_header.split(" ")[1]
+        # extract token from the header and keep it for the request. 
+        # MCP tools of an SSE session run in the context of the request that opened the session
+        auth_token.set(auth_header.split(" ")[-1])
     
     response = await call_next(request)
     
     return response
 
-
+def current_tenant() -> Tenant:
+    """The tenant of the current request"""
+    return tenants.get(tenants.tenant_id(auth_token.get()))
 
 @mcp.tool()
+@metrics.instrument("mcp_tool_duration_seconds", tool="remember")
+@tool_runner.offload
 def remember(role: str, contents) -> str:
     """Remembers new data in the memory"""
 
-    Memory(config).remember(role, contents)
+    tenant = current_tenant()
+    if tenant.write_buffer:
+        tenant.write_buffer.add(role, contents)
+    else:
+        tenant.memory.remember(role, contents)
 
     return "ok"
 
 @mcp.tool()
-def recall() -> str:
-    """Recall the memory"""
+@metrics.instrument("mcp_tool_duration_seconds", tool="remember_batch")
+@tool_runner.offload
+def remember_batch(messages: list[dict]) -> str:
+    """Remembers many messages at once. Each message is an object with `role` and `contents`"""
+
+    tenant = current_tenant()
+    if tenant.write_buffer:
+        # keep the order of messages buffered before
+        tenant.write_buffer.flush()
+
+    count = tenant.memory.remember_batch([(message["role"], message["contents"]) for message in messages])
+
+    return f"ok: {count}"
+
+@mcp.tool()
+@metrics.instrument("mcp_tool_duration_seconds", tool="recall")
+@tool_runner.offload
+def recall(query: str | None = None, budget: int | None = None) -> str:
+    """Recall the memory. With `query` the memories relevant to it go first. 
+    `budget` is the maximum size of the result in symbols"""
     
-    r = Memory(config).recall()
+    r = current_tenant().memory.recall(query, budget)
 
     if not r:
         return "none"
@@ -74,13 +102,78 @@ def recall() -> str:
     return r
 
 @mcp.tool()
-def search_in_memory(data: str) -> str:
-    """Searches for data in the memory"""
+@metrics.instrument("mcp_tool_duration_seconds", tool="history_page")
+@tool_runner.offload
+def history_page(
+    start_id: int = 0,
+    limit: int = 100,
+    end_id: int | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    role: str | None = None,
+) -> str:
+    """Returns a page of the remembered messages ordered by id, starting from `start_id`.
+    `since` and `until` select messages stored in the time range, ISO 8601 like 2025-01-31 or 2025-01-31T18:00:00Z.
+    `role` selects messages of one role, like user.
+    The last line tells the `start_id` of the next page if there are more messages"""
+
+    tenant = current_tenant()
+    if tenant.write_buffer:
+        tenant.write_buffer.flush()
+
+    rows, next_start_id = tenant.memory.history_page(start_id, end_id, limit, since, until, role)
+
+    lines = [f"{row_id}: {role}: {content}" for row_id, role, content in rows]
+    if next_start_id is not None:
+        lines.append(f"next_start_id: {next_start_id}")
+
+    if not lines:
+        return "No messages found"
+    return "\n".join(lines)
+
+@mcp.tool()
+@metrics.instrument("mcp_tool_duration_seconds", tool="search_in_memory")
+@tool_runner.offload
+def search_in_memory(
+    data: str,
+    limit: int | None = None,
+    window: int | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    role: str | None = None,
+) -> str:
+    """Searches for data in the memory. Returns the best matches, each with the messages around it.
+    `limit` is the maximum number of matches, `window` is the number of messages before and after each match.
+    `since` and `until` select matches stored in the time range, ISO 8601 like 2025-01-31 or 2025-01-31T18:00:00Z.
+    `role` selects matches of one role, like user"""
     
-    result = Memory(config).search(data)
+    tenant = current_tenant()
+    if tenant.write_buffer:
+        tenant.write_buffer.flush()
+
+    result = tenant.memory.search(data, limit, window, since, until, role)
     
     if not result:
         return "No results found"
     return result
 
+@mcp.tool()
+@metrics.instrument("mcp_tool_duration_seconds", tool="semantic_search")
+@tool_runner.offload
+def semantic_search(query: str, limit: int | None = None, window: int | None = None) -> str:
+    """Searches the memory for messages with a meaning close to the query. Returns the best matches, each with the messages around it.
+    `limit` is the maximum number of matches, `window` is the number of messages before and after each match"""
+
+    result = current_tenant().memory.semantic_search(query, limit, window)
+
+    if not result:
+        return "No results found"
+    return result
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Metrics of the server in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# must be the last, it takes all paths not matched by the routes above
 app.mount("/", mcp.sse_app())
\ No newline at end of file